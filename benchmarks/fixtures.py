@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Synthetic GeoNames Fixtures
+#
+# Deterministic stand-ins for the GeoNames dumps (citiesN.zip, alternateNamesV2.zip, countryInfo.txt, admin codes)
+# and the reference file, in the same formats, at any size. The same seed and sizes always give the same files.
+#
+# Usage: python benchmarks/fixtures.py <directory> [--cities 50000] [--seed 1]
+
+import argparse
+import csv
+import itertools
+import os
+import random
+import string
+import zipfile
+
+# Languages used for alternate names (including some that the script excludes)
+altname_languages = ["en", "de", "fr", "es", "it", "ru", "zh", "ja", "ar", "", "link", "wkdt", "post", "iata"]
+
+
+# Two letter country codes (AA, AB, ...)
+def get_country_codes(count):
+    return ["".join(pair) for pair in itertools.islice(itertools.product(string.ascii_uppercase, repeat=2), count)]
+
+
+# Random name from syllables, e.g. "Kamorin"
+def random_name(rng):
+    syllables = ["ka", "mo", "rin", "ta", "lo", "ber", "san", "vi", "ne", "gor", "ü", "é", "stadt", "ville", "burg"]
+    return "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()
+
+
+# Write text to a file inside a zip file
+def write_zip(path, member, text):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(member, text)
+
+
+# Create a cities dataset with the GeoNames columns. Names repeat within a country so there are duplicates to look up.
+def make_cities(count, countries, seed):
+    rng = random.Random(seed)
+    country_codes = get_country_codes(countries)
+    names = [random_name(rng) for _ in range(max(count // 3, 1))]
+    cities = []
+    for i in range(count):
+        cities.append(
+            {
+                "geonameid": 1000000 + i,
+                "name": rng.choice(names),
+                "lat": round(rng.uniform(-60, 70), 5),
+                "lng": round(rng.uniform(-180, 180), 5),
+                "feature_code": rng.choice(["PPL", "PPL", "PPL", "PPLA", "PPLA2", "PPLC", "PPLX"]),
+                "country": rng.choice(country_codes),
+                "admin1": str(rng.randint(1, 20)).zfill(2),
+                "admin2": str(rng.randint(1, 50)).zfill(3),
+                "population": int(rng.paretovariate(1.2) * 500),
+                "elevation": rng.choice(["", str(rng.randint(0, 3000))]),
+            }
+        )
+    return cities
+
+
+# Write citiesN.zip (containing citiesN.txt)
+def write_cities(directory, cities, threshold=1000):
+    lines = []
+    for city in cities:
+        asciiname = city["name"].replace("ü", "u").replace("é", "e")
+        fields = [
+            city["geonameid"], city["name"], asciiname, "", city["lat"], city["lng"], "P", city["feature_code"], city["country"], "",
+            city["admin1"], city["admin2"], "", "", city["population"], city["elevation"], "0", "Etc/UTC", "2024-01-01",
+        ]
+        lines.append("\t".join(str(field) for field in fields))
+    write_zip(os.path.join(directory, f"cities{threshold}.zip"), f"cities{threshold}.txt", "\n".join(lines) + "\n")
+
+
+# Write alternateNamesV2.zip. Like the real dump, most lines are for places that aren't in the cities dataset.
+def write_alternate_names(directory, cities, names_per_city, other_lines, seed):
+    rng = random.Random(seed + 1)
+    lines = []
+    alternate_name_id = 1
+    for city in cities:
+        for _ in range(names_per_city):
+            lines.append(f"{alternate_name_id}\t{city['geonameid']}\t{rng.choice(altname_languages)}\t{random_name(rng)}\t\t\t\t\t\t")
+            alternate_name_id += 1
+    for _ in range(other_lines):
+        lines.append(f"{alternate_name_id}\t{rng.randint(1, 999999)}\t{rng.choice(altname_languages)}\t{random_name(rng)}\t\t\t\t\t\t")
+        alternate_name_id += 1
+    rng.shuffle(lines)
+    write_zip(os.path.join(directory, "alternateNamesV2.zip"), "alternateNamesV2.txt", "\n".join(lines) + "\n")
+
+
+# Write countryInfo.txt
+def write_country_info(directory, countries):
+    lines = ["# GeoNames country info (synthetic)", "#ISO\tISO3\tISO-Numeric\tfips\tCountry\tCapital\tArea(in sq km)\tPopulation\tContinent\ttld\tCurrencyCode\tCurrencyName\tPhone\tPostal Code Format\tPostal Code Regex\tLanguages\tgeonameid\tneighbours\tEquivalentFipsCode"]
+    for i, code in enumerate(get_country_codes(countries)):
+        lines.append("\t".join([code, code + "X", str(i), code, f"Country {code}", f"Capital {code}", "1000", "1000000", "EU", "." + code.lower(), "EUR", "Euro", "+1", "", "", "en", str(i), "", ""]))
+    with open(os.path.join(directory, "countryInfo.txt"), "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+# Write admin1CodesASCII.txt and admin2Codes.txt
+def write_admin_codes(directory, countries):
+    with open(os.path.join(directory, "admin1CodesASCII.txt"), "w", encoding="utf-8") as file:
+        for code in get_country_codes(countries):
+            for admin1 in range(1, 21):
+                file.write(f"{code}.{admin1:02d}\tState {code}{admin1}\tState {code}{admin1}\t0\n")
+    with open(os.path.join(directory, "admin2Codes.txt"), "w", encoding="utf-8") as file:
+        for code in get_country_codes(countries):
+            for admin1 in range(1, 21):
+                for admin2 in range(1, 51):
+                    file.write(f"{code}.{admin1:02d}.{admin2:03d}\tCounty {admin2}\tCounty {admin2}\t0\n")
+
+
+# State, county and elevation of a city (as in the reference file and the provider stand-in)
+def get_lookup_values(city):
+    return f"State {city['country']}{int(city['admin1'])}", f"County {int(city['admin2'])}", int(city["elevation"] or 0)
+
+
+# Write the reference file, covering a fraction of the cities
+def write_reference(directory, cities, coverage, seed):
+    rng = random.Random(seed + 2)
+    with open(os.path.join(directory, "world_cities_(including_all_states_counties_elevations).csv"), "w", encoding="utf-8", newline="") as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(["country", "state", "county", "name", "lat", "lng", "elevation"])
+        for city in cities:
+            if rng.random() < coverage:
+                state, county, elevation = get_lookup_values(city)
+                csv_writer.writerow([city["country"], state, county, city["name"], city["lat"], city["lng"], elevation])
+
+
+# Write every fixture into a directory
+def write_fixtures(directory, cities=50000, countries=200, altnames_per_city=5, altnames_other_lines=100000, reference_coverage=0.9, threshold=1000, seed=1):
+    os.makedirs(directory, exist_ok=True)
+    city_rows = make_cities(cities, countries, seed)
+    write_cities(directory, city_rows, threshold)
+    write_alternate_names(directory, city_rows, altnames_per_city, altnames_other_lines, seed)
+    write_country_info(directory, countries)
+    write_admin_codes(directory, countries)
+    write_reference(directory, city_rows, reference_coverage, seed)
+    return city_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python benchmarks/fixtures.py", description="Write synthetic GeoNames fixtures.")
+    parser.add_argument("directory", help="Directory to write the fixtures to.")
+    parser.add_argument("--cities", type=int, default=50000, help="Number of cities. Default: 50000.")
+    parser.add_argument("--countries", type=int, default=200, help="Number of countries. Default: 200.")
+    parser.add_argument("--altnames_per_city", type=int, default=5, help="Alternate names per city. Default: 5.")
+    parser.add_argument("--altnames_other_lines", type=int, default=100000, help="Alternate names for places that aren't cities. Default: 100000.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed. Default: 1.")
+    args = parser.parse_args()
+    write_fixtures(args.directory, args.cities, args.countries, args.altnames_per_city, args.altnames_other_lines, seed=args.seed)
+    print(f"> Wrote fixtures for {args.cities} cities to {args.directory}")
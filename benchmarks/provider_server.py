@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# Provider Stand-in Server
+#
+# A local stand-in for the geocode.maps.co, geo.fcc.gov and api.open-meteo.com apis, answering from the synthetic
+# fixture cities (see fixtures.py), or from a reference file with --data. Places that aren't in the data get
+# made up (but repeatable) answers. Latency, jitter, 429 and 503 responses, and request quotas can be set, so the
+# lookups, backoff and resume can be load tested without network access or spending api quota.
+#
+# Usage:
+#   python benchmarks/provider_server.py [--port 8090] [--latency 0.05] [--jitter 0.02] [--error_429 0.01] [--quota 1000 --quota_window 60]
+#   python get_world_cities_geo_data.py ... --geocode_url http://127.0.0.1:8090 --fcc_url http://127.0.0.1:8090 --open_meteo_url http://127.0.0.1:8090
+#
+# GET /stats returns the number of requests and responses of each status code for each api.
+
+import argparse
+import csv
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures
+
+parser = argparse.ArgumentParser(prog="python benchmarks/provider_server.py", description="Local stand-in for the geocode, geo.fcc.gov and open meteo apis.")
+parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on. Default: 127.0.0.1.")
+parser.add_argument("--port", type=int, default=8090, help="Port to listen on. Default: 8090.")
+parser.add_argument("--data", type=str, help="Answer from this reference file (country,state,county,name,lat,lng,elevation) instead of the fixture cities.")
+parser.add_argument("--cities", type=int, default=50000, help="Number of fixture cities (use the same sizes and seed as fixtures.py). Default: 50000.")
+parser.add_argument("--countries", type=int, default=200, help="Number of fixture countries. Default: 200.")
+parser.add_argument("--seed", type=int, default=1, help="Random seed for the fixtures, latency and errors. Default: 1.")
+parser.add_argument("--latency", type=float, default=0.05, help="Seconds to wait before each response. Default: 0.05.")
+parser.add_argument("--jitter", type=float, default=0.02, help="Up to this many seconds are added to the latency at random. Default: 0.02.")
+parser.add_argument("--error_429", type=float, default=0, help="Fraction of requests that get a 429 response. Default: 0.")
+parser.add_argument("--error_503", type=float, default=0, help="Fraction of requests that get a 503 response. Default: 0.")
+parser.add_argument("--retry_after", type=int, default=1, help="Retry-After seconds sent with the random 429 responses. Default: 1.")
+parser.add_argument("--quota", type=int, default=0, help="Requests allowed per api in each quota window (then 429 until the window ends). Default: 0 (no quota).")
+parser.add_argument("--quota_window", type=float, default=60, help="Length of the quota window in seconds. Default: 60.")
+
+# Most coordinates the open meteo elevation api accepts per request
+open_meteo_max_coordinates = 100
+
+
+# Key for a coordinate, so coordinates match however they were formatted
+def coordinate_key(lat, lng):
+    return (round(float(lat), 5), round(float(lng), 5))
+
+
+# Load the state, county and elevation of each coordinate
+def load_places(args):
+    places = {}
+    if args.data:
+        with open(args.data, "r", encoding="utf-8", newline="") as file:
+            for row in csv.DictReader(file):
+                places[coordinate_key(row["lat"], row["lng"])] = (row.get("state", ""), row.get("county", ""), int(float(row.get("elevation") or 0)))
+    else:
+        for city in fixtures.make_cities(args.cities, args.countries, args.seed):
+            places[coordinate_key(city["lat"], city["lng"])] = fixtures.get_lookup_values(city)
+    return places
+
+
+class ProviderStandIn:
+    def __init__(self, args, places):
+        self.args = args
+        self.places = places
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.windows = {}
+
+    # State, county and elevation of a coordinate (made up from the coordinate if it isn't in the data)
+    def lookup(self, lat, lng):
+        place = self.places.get(coordinate_key(lat, lng))
+        if place is None:
+            lat = float(lat)
+            lng = float(lng)
+            place = (f"State {int(lat)}", f"County {int(lng)}", int(abs(lat * lng)) % 3000)
+        return place
+
+    # Count a response to an api
+    def count(self, api, status):
+        with self.lock:
+            stats = self.stats.setdefault(api, {"requests": 0})
+            stats["requests"] += 1
+            stats[str(status)] = stats.get(str(status), 0) + 1
+
+    # Check the quota and the random errors, returning (status, Retry-After) or None to answer normally
+    def check_limits(self, api):
+        with self.lock:
+            if self.args.quota > 0:
+                now = time.monotonic()
+                window_start, used = self.windows.get(api, (now, 0))
+                if now - window_start >= self.args.quota_window:
+                    window_start, used = now, 0
+                if used >= self.args.quota:
+                    return 429, max(1, round(window_start + self.args.quota_window - now))
+                self.windows[api] = (window_start, used + 1)
+            chance = self.random.random()
+            delay = self.args.latency + self.random.uniform(0, self.args.jitter)
+        time.sleep(delay)
+        if chance < self.args.error_429:
+            return 429, self.args.retry_after
+        if chance < self.args.error_429 + self.args.error_503:
+            return 503, None
+        return None
+
+    # Answer a request, returning (api, status, body, headers)
+    def handle(self, path, query):
+        if path == "/stats":
+            with self.lock:
+                return None, 200, json.dumps(self.stats), {}
+
+        apis = {"/reverse": "geocode", "/api/census/area": "geo_fcc", "/v1/elevation": "open_meteo"}
+        api = apis.get(path)
+        if api is None:
+            return None, 404, json.dumps({"error": "not found"}), {}
+
+        limit = self.check_limits(api)
+        if limit is not None:
+            status, retry_after = limit
+            return api, status, json.dumps({"error": "rate limit exceeded" if status == 429 else "service unavailable"}), {"Retry-After": str(retry_after)} if retry_after else {}
+
+        try:
+            if api == "geocode":
+                if not query.get("api_key"):
+                    return api, 401, json.dumps({"error": "missing api_key"}), {}
+                state, county, elevation = self.lookup(query["lat"][0], query["lon"][0])
+                return api, 200, json.dumps({"lat": query["lat"][0], "lon": query["lon"][0], "address": {"state": state, "county": county}}), {}
+
+            if api == "geo_fcc":
+                state, county, elevation = self.lookup(query["lat"][0], query["lon"][0])
+                return api, 200, json.dumps({"results": [{"county_name": county, "state_name": state}]}), {}
+
+            latitudes = [float(lat) for lat in query["latitude"][0].split(",")]
+            longitudes = [float(lng) for lng in query["longitude"][0].split(",")]
+            if len(latitudes) != len(longitudes) or len(latitudes) > open_meteo_max_coordinates:
+                return api, 400, json.dumps({"error": True, "reason": "Parameter 'latitude' and 'longitude' must have the same number of elements, at most 100"}), {}
+            if any(abs(lat) > 90 or abs(lng) > 180 for lat, lng in zip(latitudes, longitudes)):
+                return api, 400, json.dumps({"error": True, "reason": "Latitude must be in range of -90 to 90°. Longitude must be in range of -180 to 180°."}), {}
+            elevations = [float(self.lookup(lat, lng)[2]) for lat, lng in zip(latitudes, longitudes)]
+            return api, 200, json.dumps({"elevation": elevations}), {}
+        except (KeyError, ValueError):
+            return api, 400, json.dumps({"error": True, "reason": "Invalid parameters"}), {}
+
+
+# Request handler (HTTP/1.1 so clients can keep connections alive)
+class ProviderRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and body are sent separately, so don't hold the body back waiting for the client to acknowledge the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        api, status, body, headers = self.server.stand_in.handle(url.path, parse_qs(url.query))
+        if api is not None:
+            self.server.stand_in.count(api, status)
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    args = parser.parse_args()
+    places = load_places(args)
+    server = http.server.ThreadingHTTPServer((args.host, args.port), ProviderRequestHandler)
+    server.daemon_threads = True
+    server.stand_in = ProviderStandIn(args, places)
+    print(f"> Answering for {len(places)} places on http://{args.host}:{args.port} (CTRL+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(json.dumps(server.stand_in.stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
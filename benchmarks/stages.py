@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Stage Benchmarks
+#
+# Runs each stage of the pipeline on synthetic GeoNames fixtures (see fixtures.py), without any network access,
+# and records the wall time and peak memory of each stage. Results can be saved as a JSON baseline, and compared
+# against a saved baseline to catch regressions (exits with an error if a stage is slower or uses more memory than
+# the baseline allows).
+#
+# Usage:
+#   python benchmarks/stages.py --save benchmarks/baseline.json
+#   python benchmarks/stages.py --baseline benchmarks/baseline.json [--tolerance 0.25] [--time_tolerance 1]
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+
+parser = argparse.ArgumentParser(prog="python benchmarks/stages.py", description="Per stage benchmarks for get_world_cities_geo_data.py.")
+parser.add_argument("--cities", type=int, default=50000, help="Number of cities in the fixtures. Default: 50000.")
+parser.add_argument("--altnames_per_city", type=int, default=5, help="Alternate names per city. Default: 5.")
+parser.add_argument("--altnames_other_lines", type=int, default=100000, help="Alternate names for places that aren't cities. Default: 100000.")
+parser.add_argument("--seed", type=int, default=1, help="Random seed for the fixtures. Default: 1.")
+parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs (the fastest is kept). Default: 5.")
+parser.add_argument("--save", type=str, help="Save the results to this JSON file.")
+parser.add_argument("--baseline", type=str, help="Compare the results with this baseline JSON file.")
+parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed memory growth over the baseline. Default: 0.25 (25%%).")
+parser.add_argument("--time_tolerance", type=float, default=1, help="Allowed slowdown over the baseline. Wall times vary by up to 50%% between runs on a busy or shared machine, so only a stage that takes twice as long fails by default. Default: 1 (100%%).")
+parser.add_argument("--min_seconds", type=float, default=0.05, help="Stages faster than this are not checked for time regressions (they are too short to time reliably). Default: 0.05.")
+
+
+# Run each stage once, returning {stage: (seconds, peak bytes or None, rows in, rows out)}
+def run_stages(m, measure_memory):
+    results = {}
+
+    @contextlib.contextmanager
+    def stage(name):
+        counts = {"in": 0, "out": 0}
+        if measure_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        else:
+            # Timed runs start each stage with no garbage and no collections, so a collection of an earlier stage's
+            # garbage doesn't land in whichever stage happens to trigger it
+            gc.collect()
+            gc.disable()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield counts
+        finally:
+            seconds = time.perf_counter() - start
+            gc.enable()
+        peak = tracemalloc.get_traced_memory()[1] - base if measure_memory else None
+        results[name] = (seconds, peak, counts["in"], counts["out"])
+
+    # Options for a dataset with every stage enabled (states and counties for duplicate names, as preset 3)
+    m.reset_include_attributes()
+    for option in ["include_country_code", "include_country_name", "include_altnames", "include_state", "include_county", "include_state_for_dupe", "include_county_for_dupe", "include_population", "include_capital", "include_continent"]:
+        setattr(m, option, True)
+    m.combined_dataset = {}
+    m.cities_dataset = ("cities1000.zip", "cities1000.txt")
+    m.alternative_names_dataset = ("alternateNamesV2.zip", "alternateNamesV2.txt")
+    if os.path.exists("world_cities_(including_all_states_counties_elevations).snapshot"):
+        os.remove("world_cities_(including_all_states_counties_elevations).snapshot")
+    m.ref_data = None
+
+    with stage("combine_cities_dataset") as counts:
+        m.combine_cities_dataset()
+        counts["out"] = len(m.combined_dataset)
+
+    with stage("combine_altname_dataset") as counts:
+        m.combine_altname_dataset(m.alternative_names_dataset)
+        counts["in"] = len(m.combined_dataset)
+        counts["out"] = sum(len(names) for value in m.combined_dataset.values() for names in value.alternatenames.values())
+
+    with stage("combine_country_info_dataset") as counts:
+        m.download_country_info_dataset()
+        m.combine_country_info_dataset()
+        counts["in"] = len(m.countryInfoDataset)
+        counts["out"] = len(m.combined_dataset)
+
+    with stage("create_state_geocode_list") as counts:
+        m.state_geocode_list = m.create_state_geocode_list([])
+        m.county_geocode_list = m.create_county_geocode_list([])
+        counts["in"] = len(m.combined_dataset)
+        counts["out"] = len(m.state_geocode_list)
+
+    with stage("create_reference_dataset") as counts:
+        m.create_reference_dataset()
+        counts["out"] = len(m.reference_dataset)
+
+    with stage("find_reference") as counts:
+        for geonameid in m.state_geocode_list:
+            if m.find_reference(m.combined_dataset[geonameid]) is not None:
+                counts["out"] += 1
+        counts["in"] = len(m.state_geocode_list)
+
+    with stage("generate_custom_dataset") as counts:
+        items = list(m.generate_custom_dataset(m.combined_dataset))
+        counts["in"] = len(m.combined_dataset)
+        counts["out"] = len(items)
+
+    for name, write in [
+        ("write_json", lambda outfile: m.write_json(items, outfile)),
+        ("write_ndjson", lambda outfile: m.write_ndjson(items, outfile)),
+        ("write_csv", lambda outfile: m.write_csv(items, outfile, m.get_output_keys())),
+    ]:
+        with stage(name) as counts:
+            with open(f"output.{name}", "w", encoding="utf-8", newline="") as outfile:
+                write(outfile)
+            counts["in"] = counts["out"] = len(items)
+
+    return results
+
+
+# Run the benchmarks and return the results as a dict
+def benchmark(args):
+    import get_world_cities_geo_data as m
+
+    m.parse_arguments(["-drd"])
+    m.load_libraries()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures.write_fixtures(directory, args.cities, altnames_per_city=args.altnames_per_city, altnames_other_lines=args.altnames_other_lines, seed=args.seed)
+        os.chdir(directory)
+        try:
+            timings = [run_stages(m, False) for _ in range(args.repeat)]
+            tracemalloc.start()
+            memory = run_stages(m, True)
+            tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+
+    stages = {}
+    for name in memory:
+        stages[name] = {
+            "seconds": round(min(timing[name][0] for timing in timings), 6),
+            "peak_mb": round(memory[name][1] / 1024 / 1024, 3),
+            "rows_in": memory[name][2],
+            "rows_out": memory[name][3],
+        }
+    return {
+        "version": m.version,
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} ({os.cpu_count()} cpus)",
+        "fixtures": {"cities": args.cities, "altnames_per_city": args.altnames_per_city, "altnames_other_lines": args.altnames_other_lines, "seed": args.seed},
+        "stages": stages,
+    }
+
+
+# Stages that are slower or use more memory than the baseline allows
+def find_regressions(results, baseline, tolerance, time_tolerance, min_seconds):
+    regressions = []
+    if results["fixtures"] != baseline.get("fixtures"):
+        print("! The fixture sizes differ from the baseline, so the results aren't comparable.")
+    for name, stage in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            continue
+        if stage["seconds"] >= min_seconds and stage["seconds"] > base["seconds"] * (1 + time_tolerance):
+            regressions.append(f"{name}: {stage['seconds']:.3f}s (baseline {base['seconds']:.3f}s)")
+        if stage["peak_mb"] > base["peak_mb"] * (1 + tolerance) + 1:
+            regressions.append(f"{name}: {stage['peak_mb']:.1f} MB peak (baseline {base['peak_mb']:.1f} MB)")
+        if (stage["rows_in"], stage["rows_out"]) != (base["rows_in"], base["rows_out"]):
+            regressions.append(f"{name}: rows {stage['rows_in']} -> {stage['rows_out']} (baseline {base['rows_in']} -> {base['rows_out']})")
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    results = benchmark(args)
+
+    print(f"{'stage':<30} {'seconds':>10} {'peak MB':>10} {'rows in':>10} {'rows out':>10}")
+    for name, stage in results["stages"].items():
+        print(f"{name:<30} {stage['seconds']:>10.3f} {stage['peak_mb']:>10.1f} {stage['rows_in']:>10} {stage['rows_out']:>10}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+        print(f"> Saved {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = find_regressions(results, baseline, args.tolerance, args.time_tolerance, args.min_seconds)
+        if regressions:
+            print("! Regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"> No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
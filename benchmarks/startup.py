@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Startup Benchmark
+#
+# Times how long get_world_cities_geo_data.py takes to start for --version, --convert, and a plain import,
+# and exits with an error if the median time of any of them is over the budget.
+#
+# Usage: python benchmarks/startup.py [--budget 0.25] [--runs 10]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "get_world_cities_geo_data.py")
+
+parser = argparse.ArgumentParser(prog="python benchmarks/startup.py", description="Startup time benchmark for get_world_cities_geo_data.py.")
+parser.add_argument("--budget", type=float, default=0.25, help="Maximum median startup time in seconds. Default: 0.25.")
+parser.add_argument("--runs", type=int, default=10, help="Number of runs of each command. Default: 10.")
+
+
+# Median wall time of running a command
+def time_command(command, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file = os.path.join(directory, "cities.csv")
+        with open(csv_file, "w", encoding="utf-8") as file:
+            file.write("country,name,lat,lng\nAD,Andorra la Vella,42.50779,1.52109\n")
+
+        commands = {
+            "interpreter": [sys.executable, "-c", "pass"],
+            "import": [sys.executable, "-c", f"import sys; sys.path.insert(0, {os.path.dirname(script)!r}); import get_world_cities_geo_data"],
+            "--version": [sys.executable, script, "--version"],
+            "--convert": [sys.executable, script, "--convert", csv_file],
+        }
+
+        over_budget = False
+        for name, command in commands.items():
+            median = time_command(command, args.runs)
+            status = "" if name == "interpreter" or median <= args.budget else " (over budget)"
+            over_budget = over_budget or status != ""
+            print(f"{name:<12} {median * 1000:8.1f} ms{status}")
+
+    if over_budget:
+        print(f"! Startup is over the {args.budget * 1000:.0f} ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
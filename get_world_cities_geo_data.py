@@ -13,16 +13,27 @@ version = "2.3.0"
 # ===== Import Libraries =====
 
 import argparse
+import array
+import bisect
 import csv
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
+import random
+import shutil
 import signal
+import sqlite3
+import struct
 import sys
 import time
 import zipfile
 import threading
+from collections import deque
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 # Check if extra required libraries are installed
@@ -44,14 +55,19 @@ def check_libraries(libraries):
         sys.exit(1)
 
 
-check_libraries(["enlighten", "requests", "pickledb"])
+# Extra required libraries, imported by load_libraries() only when building a dataset (so --version and --convert start quickly)
+enlighten = None
+requests = None
 
-# Continue importing libraries
-import enlighten
-import requests
-from typing import List, Optional
-from requests.exceptions import RequestException, HTTPError
-import pickle
+
+# Check and import the extra required libraries
+def load_libraries():
+    global enlighten, requests
+    if enlighten is not None and requests is not None:
+        return
+    check_libraries(["enlighten", "requests"])
+    import enlighten
+    import requests
 
 
 # ===== Argument Parser =====
@@ -66,7 +82,13 @@ parser.add_argument(
     "-v", "--version", action="store_true", help="Show the version number."
 )
 parser.add_argument(
-    "-c", "--convert", help="Convert file.csv to file.json, or vice versa."
+    "-c", "--convert", help="Convert file.csv to file.json, or file.json/file.ndjson to file.csv."
+)
+parser.add_argument(
+    "-cf",
+    "--convert_format",
+    choices=["csv", "json", "ndjson"],
+    help="Optional. Format for --convert to convert to, instead of the default.",
 )
 parser.add_argument(
     "-r", "--resume", action="store_true", help="Resume from a save file."
@@ -131,19 +153,232 @@ parser.add_argument(
     action="store_true",
     help="Pre-select options to save a CSV file with country, state, county, name, latitude, longitude and elevation. (Reference File)",
 )
+parser.add_argument(
+    "-ac",
+    "--admin_codes",
+    action="store_true",
+    help="Resolve state and county names offline from the GeoNames admin code tables (admin1CodesASCII.txt and admin2Codes.txt). The reference file and apis are only used for places without admin codes.",
+)
+parser.add_argument(
+    "-rt",
+    "--reference_tolerance",
+    type=float,
+    default=0,
+    help="Optional. Use the nearest place in the reference file within this many metres when there is no exact coordinate match. Default: 0 (exact matches only).",
+)
+parser.add_argument(
+    "-rn",
+    "--reference_match_name",
+    action="store_true",
+    help="Optional. Only use a nearby place in the reference file if it has the same name (or geonameid).",
+)
+parser.add_argument(
+    "-cp",
+    "--compact",
+    action="store_true",
+    help="Optional. Save JSON without indentation to reduce the file size.",
+)
+parser.add_argument(
+    "-m",
+    "--mirror",
+    type=str,
+    help="Optional. Directory containing local copies of the source files (GeoNames dumps and the reference file) to use instead of downloading them.",
+)
+parser.add_argument(
+    "-dc",
+    "--disable_cache",
+    action="store_true",
+    help="Don't use the local lookup cache (lookup_cache.db). Every state, county, and elevation lookup will query the api.",
+)
+parser.add_argument(
+    "-ct",
+    "--cache_ttl",
+    type=float,
+    default=90,
+    help="Optional. Number of days a cached lookup result is valid for. Default: 90.",
+)
+parser.add_argument(
+    "-cr",
+    "--coalesce_radius",
+    type=float,
+    default=0,
+    help="Optional. Share one state, county, or elevation lookup between places within this many metres of each other. Places with the same coordinates always share a lookup. Default: 0.",
+)
+parser.add_argument(
+    "-wc",
+    "--warm_cache",
+    action="store_true",
+    help="Pre-warm the local lookup cache from the reference file and exit.",
+)
+parser.add_argument(
+    "-mx",
+    "--matrix",
+    action="store_true",
+    help="Build every preset at every population threshold from a single parse of the GeoNames data. See --thresholds, --presets and --formats.",
+)
+parser.add_argument(
+    "--thresholds",
+    type=str,
+    default="500,1000,5000,15000",
+    help="Optional. Comma separated population thresholds for --matrix. Default: 500,1000,5000,15000.",
+)
+parser.add_argument(
+    "--presets",
+    type=str,
+    default="0,1,2,3,4",
+    help="Optional. Comma separated presets for --matrix. Default: 0,1,2,3,4.",
+)
+parser.add_argument(
+    "--formats",
+    type=str,
+    default="csv",
+    help="Optional. Comma separated file formats (csv, json, ndjson) for --matrix. Default: csv.",
+)
+parser.add_argument(
+    "-gr",
+    "--geocode_rate",
+    type=float,
+    default=1,
+    help="Optional. Maximum requests per second to geocode.maps.co. Default: 1.",
+)
+parser.add_argument(
+    "-gw",
+    "--geocode_workers",
+    type=int,
+    default=2,
+    help="Optional. Maximum concurrent requests to geocode.maps.co. Default: 2.",
+)
+parser.add_argument(
+    "-fr",
+    "--fcc_rate",
+    type=float,
+    default=1,
+    help="Optional. Maximum requests per second to geo.fcc.gov. Default: 1.",
+)
+parser.add_argument(
+    "-fw",
+    "--fcc_workers",
+    type=int,
+    default=2,
+    help="Optional. Maximum concurrent requests to geo.fcc.gov. Default: 2.",
+)
+parser.add_argument(
+    "-mr",
+    "--open_meteo_rate",
+    type=float,
+    default=10,
+    help="Optional. Maximum requests per second to api.open-meteo.com. Default: 10.",
+)
+parser.add_argument(
+    "-mw",
+    "--open_meteo_workers",
+    type=int,
+    default=4,
+    help="Optional. Maximum concurrent requests to api.open-meteo.com. Default: 4.",
+)
+parser.add_argument(
+    "-mb",
+    "--open_meteo_batch_size",
+    type=int,
+    default=100,
+    help="Optional. Number of coordinates to fetch elevations for per request to api.open-meteo.com (max 100). Default: 100.",
+)
+parser.add_argument(
+    "--geocode_url",
+    type=str,
+    default="https://geocode.maps.co",
+    help="Optional. Base URL of the geocode.maps.co api (e.g. a local stand-in from benchmarks/provider_server.py). Default: https://geocode.maps.co.",
+)
+parser.add_argument(
+    "--fcc_url",
+    type=str,
+    default="https://geo.fcc.gov",
+    help="Optional. Base URL of the geo.fcc.gov api. Default: https://geo.fcc.gov.",
+)
+parser.add_argument(
+    "--open_meteo_url",
+    type=str,
+    default="https://api.open-meteo.com",
+    help="Optional. Base URL of the api.open-meteo.com api. Default: https://api.open-meteo.com.",
+)
+parser.add_argument(
+    "-sv",
+    "--serve",
+    type=str,
+    help="Serve city lookups over HTTP from a generated dataset file (csv, json or ndjson). See world_cities.py for the endpoints.",
+)
+parser.add_argument(
+    "--host",
+    type=str,
+    default="127.0.0.1",
+    help="Optional. Address for --serve to listen on. Default: 127.0.0.1.",
+)
+parser.add_argument(
+    "--port",
+    type=int,
+    default=8080,
+    help="Optional. Port for --serve to listen on. Default: 8080.",
+)
+parser.add_argument(
+    "-au",
+    "--autocomplete",
+    action="store_true",
+    help="Optional. Also save a prefix autocomplete index (.autocomplete) next to each output file. See world_cities.py.",
+)
+parser.add_argument(
+    "-aw",
+    "--altnames_workers",
+    type=int,
+    default=0,
+    help="Optional. Number of processes that parse the alternate names dataset. Default: 0 (one per cpu core).",
+)
+parser.add_argument(
+    "-al",
+    "--autocomplete_languages",
+    type=str,
+    default="",
+    help="Optional. Comma separated alternate name languages (e.g. en,de,fr) to include in the autocomplete index, or 'all'. Default: none.",
+)
+parser.add_argument(
+    "-mf",
+    "--metrics",
+    type=str,
+    help="Optional. Save the time, memory and row counts of each stage, and the request metrics of each provider, to this file. Prometheus textfile format for a .prom file, otherwise JSON.",
+)
 
 
-# Parse the command-line arguments
-args = parser.parse_args()
+# Default arguments, replaced by parse_arguments() with the command-line arguments
+args = parser.parse_args([])
 
 resume = False
 log = False
+disableCache = False
+useAdminCodes = False
+compact = False
+warmCache = False
 disableReference = False
 disableReferenceDownload = False
 preset = None
 threshold = None
 threshold_prompt_fallback = False
 output = None
+mirror = None
+matrix = False
+matrix_thresholds = []
+matrix_presets = []
+matrix_formats = []
+autocomplete = False
+autocompleteLanguages = []
+provider_limits = {
+    "geocode": {"rate": args.geocode_rate, "workers": args.geocode_workers},
+    "geo_fcc": {"rate": args.fcc_rate, "workers": args.fcc_workers},
+    "open_meteo": {"rate": args.open_meteo_rate, "workers": args.open_meteo_workers, "batch_size": args.open_meteo_batch_size},
+}
+provider_urls = {
+    "geocode": args.geocode_url,
+    "geo_fcc": args.fcc_url,
+    "open_meteo": args.open_meteo_url,
+}
 
 
 # Arg - Convert
@@ -172,104 +407,230 @@ def get_custom_csv_header_order():
     return custom_order
 
 
-if args.convert:
-    filename = os.path.splitext(args.convert)[0]
-    ext = os.path.splitext(args.convert)[1]
-
-    if ext == ".csv":
-        # Read the CSV file
-        with open(args.convert, "r") as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-
-            # Convert to JSON
-            data = []
-            for row in csv_reader:
-                data.append(row)
-
-        # Write JSON data to a file
-        with open(f"{filename}.json", "w", encoding="utf-8") as json_file:
-            json.dump(data, json_file, ensure_ascii=False, indent=2)
+# Read the items of a JSON array one at a time, without loading the whole file
+def read_json_items(infile, chunk_size=1024 * 1024):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+    state = "start"
+    while True:
+        # Skip whitespace, reading more of the file when the buffer runs out
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            buffer = infile.read(chunk_size)
+            position = 0
+            eof = buffer == ""
+            continue
 
-    if ext == ".json":
-        # Custom key order
+        char = buffer[position]
+        if state == "start":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            position += 1
+            state = "first"
+        elif state in ("first", "next") and char == "]":
+            return
+        elif state == "next":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {char!r}")
+            position += 1
+            state = "item"
+        else:
+            # Decode the next item, reading more of the file if it is incomplete (or might be, if it isn't followed by a separator)
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                end = None
+            if end is None or (not eof and (end == len(buffer) or buffer[end] not in " \t\r\n,]")):
+                more = infile.read(chunk_size)
+                if more == "":
+                    if end is None:
+                        raise ValueError("Unexpected end of JSON array")
+                    eof = True
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            yield item
+            position = end
+            state = "next"
+            # Drop the items already read from the buffer
+            if position > chunk_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+# Read the items of a csv, json, or ndjson file one at a time
+def read_items(path, filetype):
+    with open(path, "r", encoding="utf-8", newline="" if filetype == "csv" else None) as infile:
+        if filetype == "csv":
+            yield from csv.DictReader(infile)
+        elif filetype == "json":
+            yield from read_json_items(infile)
+        else:
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Convert a csv, json, or ndjson file to another of these formats (csv to json, and json or ndjson to csv by default)
+def convert_file(path, target=None):
+    filename, ext = os.path.splitext(path)
+    source = ext[1:].lower()
+    if source not in ["csv", "json", "ndjson"]:
+        print(f"! Can't convert {path}. Use a .csv, .json, or .ndjson file.")
+        return
+    target = target or ("json" if source == "csv" else "csv")
+    if target == source:
+        print(f"! {path} is already {target}.")
+        return
+    output_filename = f"{filename}.{target}"
+
+    if target == "csv":
+        # Header row in the custom order, only including keys that exist. Files generated by this script have the same
+        # keys in every item, so the columns are taken from the first item, and the file is only read twice (once to
+        # find every key) if a later item has another column.
         custom_order = get_custom_csv_header_order()
-
-        # Load the JSON data from the input file
-        with open(args.convert, "r") as json_file:
-            custom_dataset_json = json.load(json_file)
-
-        # Open the CSV file for writing
-        with open(f"{filename}.csv", "w", newline="") as csv_file:
-            csv_writer = csv.writer(csv_file)
-
-            # Write the header row using the custom order, but only include existing keys
-            existing_keys = [
-                key
-                for key in custom_order
-                if any(key in item for item in custom_dataset_json)
-            ]
-            csv_writer.writerow(existing_keys)
-
-            # Write the data rows with custom key order, only including existing keys
-            for item in custom_dataset_json:
-                row_data = [item.get(key, "") for key in existing_keys]
-                csv_writer.writerow(row_data)
-    sys.exit(0)
-
-# Arg - Version
-if args.version:
-    print(f"GetWorldCities {version}")
-    sys.exit(0)
-
-# Arg - Resume
-if args.resume:
-    resume = True
-
-# Arg - Log
-if args.log:
-    log = True
-
-# Arg - Disable Reference File
-if args.disable_reference:
-    disableReference = True
-
-# Arg - Disable Reference File Download
-if args.disable_reference_download:
-    disableReferenceDownload = True
-
-# Arg - Preset
-if args.preset0:
-    preset = 0
-if args.preset1:
-    preset = 1
-if args.preset2:
-    preset = 2
-if args.preset3:
-    preset = 3
-if args.preset4:
-    preset = 4
-
-# Arg - Population Threshold
-if args.threshold in [500, 1000, 5000, 15000]:
-    threshold = args.threshold
-else:
-    threshold = 1000
-    threshold_prompt_fallback = True
-
-# Arg - Output filename
-if args.output is not None:
-    output = args.output
-
-
-# Logging Config
-if log:
-    logging.basicConfig(
-        filename="get_world_cities.log",
-        encoding="utf-8",
-        format="%(asctime)s %(levelname)-8s %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        level=logging.INFO,
-    )
+        keys = None
+        with open(output_filename, "w", encoding="utf-8", newline="") as outfile:
+            csv_writer = csv.writer(outfile)
+            for item in read_items(path, source):
+                if keys is None:
+                    seen_keys = set(item)
+                    keys = [key for key in custom_order if key in seen_keys]
+                    csv_writer.writerow(keys)
+                elif not item.keys() <= seen_keys:
+                    if any(key in custom_order and key not in keys for key in item):
+                        keys = None
+                        break
+                    seen_keys.update(item)
+                csv_writer.writerow([item.get(key, "") for key in keys])
+        if keys is None:
+            existing_keys = set()
+            for item in read_items(path, source):
+                existing_keys.update(item)
+            with open(output_filename, "w", encoding="utf-8", newline="") as outfile:
+                write_csv(read_items(path, source), outfile, [key for key in custom_order if key in existing_keys])
+    elif target == "json":
+        with open(output_filename, "w", encoding="utf-8") as outfile:
+            write_json(read_items(path, source), outfile, compact)
+    elif target == "ndjson":
+        with open(output_filename, "w", encoding="utf-8") as outfile:
+            write_ndjson(read_items(path, source), outfile)
+
+
+# Parse the command-line arguments and set the options from them
+def parse_arguments(argv=None):
+    global args, resume, log, disableCache, useAdminCodes, compact, warmCache, disableReference, disableReferenceDownload
+    global preset, threshold, threshold_prompt_fallback, output, mirror, matrix, matrix_thresholds, matrix_presets, matrix_formats, provider_limits, provider_urls
+    global autocomplete, autocompleteLanguages, metricsFile
+    args = parser.parse_args(argv)
+
+    # Arg - Resume
+    if args.resume:
+        resume = True
+
+    # Arg - Log
+    if args.log:
+        log = True
+
+    # Arg - Disable Reference File
+    if args.disable_reference:
+        disableReference = True
+
+    # Arg - Disable Reference File Download
+    if args.disable_reference_download:
+        disableReferenceDownload = True
+
+    # Arg - Local Mirror
+    if args.mirror is not None:
+        mirror = args.mirror
+
+    # Arg - Admin Codes
+    if args.admin_codes:
+        useAdminCodes = True
+
+    # Arg - Compact JSON
+    if args.compact:
+        compact = True
+
+    # Arg - Disable Lookup Cache
+    if args.disable_cache:
+        disableCache = True
+
+    # Arg - Warm Lookup Cache
+    if args.warm_cache:
+        warmCache = True
+
+    # Arg - Preset
+    if args.preset0:
+        preset = 0
+    if args.preset1:
+        preset = 1
+    if args.preset2:
+        preset = 2
+    if args.preset3:
+        preset = 3
+    if args.preset4:
+        preset = 4
+
+    # Arg - Population Threshold
+    if args.threshold in [500, 1000, 5000, 15000]:
+        threshold = args.threshold
+    else:
+        threshold = 1000
+        threshold_prompt_fallback = True
+
+    # Arg - Output filename
+    if args.output is not None:
+        output = args.output
+
+    # Arg - Matrix Build
+    if args.matrix:
+        matrix = True
+    matrix_thresholds = [int(t) for t in args.thresholds.split(",") if t.strip() in ["500", "1000", "5000", "15000"]]
+    matrix_presets = [int(p) for p in args.presets.split(",") if p.strip() in ["0", "1", "2", "3", "4"]]
+    matrix_formats = [f.strip() for f in args.formats.split(",") if f.strip() in ["csv", "json", "ndjson"]]
+
+    # Arg - Autocomplete Index
+    if args.autocomplete:
+        autocomplete = True
+    autocompleteLanguages = [language.strip() for language in args.autocomplete_languages.split(",") if language.strip()]
+
+    # Arg - Metrics File
+    if args.metrics is not None:
+        metricsFile = args.metrics
+
+    # Arg - Lookup rate limits and concurrency
+    for option, rate in [("--geocode_rate", args.geocode_rate), ("--fcc_rate", args.fcc_rate), ("--open_meteo_rate", args.open_meteo_rate)]:
+        if not rate > 0:
+            parser.error(f"{option} must be greater than 0")
+    provider_limits = {
+        "geocode": {"rate": args.geocode_rate, "workers": args.geocode_workers},
+        "geo_fcc": {"rate": args.fcc_rate, "workers": args.fcc_workers},
+        "open_meteo": {"rate": args.open_meteo_rate, "workers": args.open_meteo_workers, "batch_size": args.open_meteo_batch_size},
+    }
+    reset_rate_limiters()
+
+    # Arg - Provider base URLs
+    provider_urls = {
+        "geocode": args.geocode_url.rstrip("/"),
+        "geo_fcc": args.fcc_url.rstrip("/"),
+        "open_meteo": args.open_meteo_url.rstrip("/"),
+    }
+
+    # Logging Config
+    if log:
+        logging.basicConfig(
+            filename="get_world_cities.log",
+            encoding="utf-8",
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+            level=logging.INFO,
+        )
 
 
 # ===== Spinner =====
@@ -304,6 +665,244 @@ def stop_spinner(end_text=""):
     sys.stdout.flush()
 
 
+# ===== Metrics =====
+
+# Peak memory is read from /proc on Linux (so it can be reset for each stage), or from getrusage elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+metricsFile = None
+metrics_started = time.time()
+metrics_stages = {}
+metrics_stack = []
+provider_metrics = {}
+provider_metrics_lock = threading.Lock()
+# Upper bounds (in seconds) of the provider request latency histogram buckets
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+# Peak resident memory of the process in MB (since the last reset_peak_rss() on Linux), or None if it can't be read
+def get_peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (IOError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+# Reset the peak resident memory to the current usage (Linux only)
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except (IOError, ValueError):
+        pass
+
+
+# Get the metrics of a stage, adding it if it is new
+def get_stage_metrics(name):
+    stage = metrics_stages.get(name)
+    if stage is None:
+        stage = metrics_stages[name] = {"runs": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": None, "rows_in": 0, "rows_out": 0}
+    return stage
+
+
+# Add a run of a stage to its metrics (stages that run more than once, e.g. a download per file, are summed)
+def record_stage(name, wall_seconds, cpu_seconds, rows_in=0, rows_out=0, peak_rss_mb=None):
+    stage = get_stage_metrics(name)
+    stage["runs"] += 1
+    stage["wall_seconds"] += wall_seconds
+    stage["cpu_seconds"] += cpu_seconds
+    stage["rows_in"] += rows_in
+    stage["rows_out"] += rows_out
+    if peak_rss_mb is not None:
+        stage["peak_rss_mb"] = max(stage["peak_rss_mb"] or 0, peak_rss_mb)
+
+
+# Rows counted by a stage so far
+def get_stage_rows(name):
+    stage = metrics_stages.get(name)
+    return (stage["rows_in"], stage["rows_out"]) if stage else (0, 0)
+
+
+# Start timing a stage. Stages can be nested, and the time of a nested stage isn't counted in the stage around it.
+def start_stage(name):
+    reset_peak_rss()
+    metrics_stack.append([name, time.perf_counter(), time.process_time(), 0.0, 0.0, 0.0])
+
+
+# Stop timing a stage (worker_cpu_seconds is the CPU time of any worker processes, which isn't counted in this process)
+def stop_stage(name, rows_in=0, rows_out=0, worker_cpu_seconds=0):
+    stage_name, wall_start, cpu_start, nested_wall, nested_cpu, nested_peak = metrics_stack.pop()
+    if stage_name != name:
+        logging.error(f"Metrics stage {stage_name} was stopped as {name}")
+    wall_seconds = time.perf_counter() - wall_start
+    cpu_seconds = time.process_time() - cpu_start + worker_cpu_seconds
+    peak_rss_mb = get_peak_rss_mb()
+    record_stage(stage_name, wall_seconds - nested_wall, cpu_seconds - nested_cpu, rows_in, rows_out, max(peak_rss_mb or 0, nested_peak) or None)
+    add_nested_time(wall_seconds, cpu_seconds, max(peak_rss_mb or 0, nested_peak))
+
+
+# Add time that was spent in a nested stage to the stage around it (so it can be taken off that stage's time)
+def add_nested_time(wall_seconds, cpu_seconds, peak_rss_mb=0):
+    if metrics_stack:
+        outer = metrics_stack[-1]
+        outer[3] += wall_seconds
+        outer[4] += cpu_seconds
+        outer[5] = max(outer[5], peak_rss_mb or 0)
+
+
+# Record time that was measured piece by piece inside another stage (e.g. unzipping while the cities are joined)
+def record_nested_stage(name, wall_seconds, cpu_seconds, rows_in=0, rows_out=0):
+    peak_rss_mb = get_peak_rss_mb()
+    record_stage(name, wall_seconds, cpu_seconds, rows_in, rows_out, peak_rss_mb)
+    add_nested_time(wall_seconds, cpu_seconds)
+
+
+# Get the metrics of a provider, adding it if it is new
+def get_provider_metrics(provider):
+    metrics = provider_metrics.get(provider)
+    if metrics is None:
+        metrics = provider_metrics[provider] = {"requests": 0, "latency_buckets": [0] * (len(latency_buckets) + 1), "latency_sum": 0.0, "responses": {}, "errors": 0, "retries": 0, "coalesced": 0}
+    return metrics
+
+
+# Record a request to a provider (status is None if no response was received)
+def record_provider_request(provider, seconds, status):
+    with provider_metrics_lock:
+        metrics = get_provider_metrics(provider)
+        metrics["requests"] += 1
+        metrics["latency_buckets"][bisect.bisect_left(latency_buckets, seconds)] += 1
+        metrics["latency_sum"] += seconds
+        if status is None:
+            metrics["errors"] += 1
+        else:
+            metrics["responses"][str(status)] = metrics["responses"].get(str(status), 0) + 1
+
+
+# Record a retry of a request to a provider
+def record_provider_retry(provider):
+    with provider_metrics_lock:
+        get_provider_metrics(provider)["retries"] += 1
+
+
+# Record lookups saved by sharing a lookup between places
+def record_provider_coalesced(provider, saved):
+    with provider_metrics_lock:
+        get_provider_metrics(provider)["coalesced"] += saved
+
+
+# Get the metrics as a dict
+def get_metrics():
+    providers = {}
+    with provider_metrics_lock:
+        for provider, metrics in provider_metrics.items():
+            # The histogram buckets are cumulative (the count of requests at or under each bound), as in Prometheus
+            buckets = {}
+            count = 0
+            for bound, bucket_count in zip(latency_buckets + ["+Inf"], metrics["latency_buckets"]):
+                count += bucket_count
+                buckets[str(bound)] = count
+            providers[provider] = {
+                "requests": metrics["requests"],
+                "latency_seconds_sum": round(metrics["latency_sum"], 6),
+                "latency_seconds_buckets": buckets,
+                "responses": dict(metrics["responses"]),
+                "rate_limited": metrics["responses"].get("429", 0),
+                "errors": metrics["errors"],
+                "retries": metrics["retries"],
+                "coalesced": metrics["coalesced"],
+            }
+    stages = {}
+    for name, stage in metrics_stages.items():
+        stages[name] = {
+            "runs": stage["runs"],
+            "wall_seconds": round(stage["wall_seconds"], 6),
+            "cpu_seconds": round(stage["cpu_seconds"], 6),
+            "peak_rss_mb": round(stage["peak_rss_mb"], 1) if stage["peak_rss_mb"] is not None else None,
+            "rows_in": stage["rows_in"],
+            "rows_out": stage["rows_out"],
+        }
+    return {
+        "version": version,
+        "started": round(metrics_started, 3),
+        "wall_seconds": round(time.time() - metrics_started, 3),
+        "stages": stages,
+        "providers": providers,
+    }
+
+
+# Format the metrics as a Prometheus textfile (for the node exporter textfile collector)
+def format_prometheus_metrics(metrics):
+    lines = []
+
+    def add_metric(name, metric_type, description, samples):
+        lines.append(f"# HELP world_cities_{name} {description}")
+        lines.append(f"# TYPE world_cities_{name} {metric_type}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"world_cities_{name}{{{label_text}}} {value}" if label_text else f"world_cities_{name} {value}")
+
+    stages = metrics["stages"]
+    providers = metrics["providers"]
+    add_metric("build_started_seconds", "gauge", "Unix time the build started.", [({}, metrics["started"])])
+    add_metric("build_wall_seconds", "gauge", "Wall time of the build.", [({}, metrics["wall_seconds"])])
+    add_metric("stage_wall_seconds", "gauge", "Wall time of each stage (not counting nested stages).", [({"stage": name}, stage["wall_seconds"]) for name, stage in stages.items()])
+    add_metric("stage_cpu_seconds", "gauge", "CPU time of each stage (not counting nested stages).", [({"stage": name}, stage["cpu_seconds"]) for name, stage in stages.items()])
+    add_metric("stage_peak_rss_bytes", "gauge", "Peak resident memory while each stage ran.", [({"stage": name}, int(stage["peak_rss_mb"] * 1024 * 1024)) for name, stage in stages.items() if stage["peak_rss_mb"] is not None])
+    add_metric("stage_rows_in", "gauge", "Rows read by each stage.", [({"stage": name}, stage["rows_in"]) for name, stage in stages.items()])
+    add_metric("stage_rows_out", "gauge", "Rows produced by each stage.", [({"stage": name}, stage["rows_out"]) for name, stage in stages.items()])
+    add_metric("stage_runs", "gauge", "Number of times each stage ran.", [({"stage": name}, stage["runs"]) for name, stage in stages.items()])
+
+    lines.append("# HELP world_cities_provider_request_seconds Latency of requests to each provider.")
+    lines.append("# TYPE world_cities_provider_request_seconds histogram")
+    for provider, metrics in providers.items():
+        for bound, count in metrics["latency_seconds_buckets"].items():
+            lines.append(f'world_cities_provider_request_seconds_bucket{{provider="{provider}",le="{bound}"}} {count}')
+        lines.append(f'world_cities_provider_request_seconds_sum{{provider="{provider}"}} {metrics["latency_seconds_sum"]}')
+        lines.append(f'world_cities_provider_request_seconds_count{{provider="{provider}"}} {metrics["requests"]}')
+    add_metric("provider_responses_total", "counter", "Responses from each provider by status code.", [({"provider": provider, "code": code}, count) for provider, metrics in providers.items() for code, count in metrics["responses"].items()])
+    add_metric("provider_errors_total", "counter", "Requests to each provider that got no response.", [({"provider": provider}, metrics["errors"]) for provider, metrics in providers.items()])
+    add_metric("provider_retries_total", "counter", "Retried requests to each provider.", [({"provider": provider}, metrics["retries"]) for provider, metrics in providers.items()])
+    add_metric("provider_coalesced_total", "counter", "Lookups saved by sharing a lookup between places.", [({"provider": provider}, metrics["coalesced"]) for provider, metrics in providers.items()])
+    return "\n".join(lines) + "\n"
+
+
+# Write the metrics file (Prometheus textfile format for a .prom file, otherwise JSON)
+def write_metrics():
+    if metricsFile is None:
+        return
+
+    # Stop any stages that are still running (when the build is stopped part way)
+    while metrics_stack:
+        stop_stage(metrics_stack[-1][0])
+
+    metrics = get_metrics()
+    try:
+        # Write to a temporary file first so a collector never reads a partial file
+        with open(metricsFile + ".tmp", "w", encoding="utf-8") as file:
+            if metricsFile.endswith(".prom"):
+                file.write(format_prometheus_metrics(metrics))
+            else:
+                json.dump(metrics, file, indent=2)
+                file.write("\n")
+        os.replace(metricsFile + ".tmp", metricsFile)
+        logging.info(f"Saving file: {metricsFile}")
+        print(f"> Saved metrics to {metricsFile}")
+    except IOError as e:
+        logging.error(f"Failed to save {metricsFile}. {e}")
+        print(f"! Failed to save {metricsFile}")
+
+
 # ===== Define US States =====
 
 # Define a dictionary to map full state names to abbreviations for all US states.
@@ -399,43 +998,144 @@ def prompt_geocode_api_key():
 # ===== Download Functions =====
 
 
-# File Downloader
+# Download metadata (ETag/Last-Modified of the saved file, and the validator of a partial download)
+def load_download_meta(filename):
+    meta_filename = f"{filename}.meta.json"
+    if os.path.exists(meta_filename):
+        try:
+            with open(meta_filename, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (IOError, ValueError) as e:
+            logging.error(f"Could not read {meta_filename}. {e}")
+    return {}
+
+
+def save_download_meta(filename, meta):
+    with open(f"{filename}.meta.json", "w", encoding="utf-8") as file:
+        json.dump(meta, file, indent=2)
+
+
+# File Downloader (conditional request, streamed to a .part file that is resumed if interrupted, and only replaces the file once complete)
 def download_file(url, filename):
+    part_filename = f"{filename}.part"
+    meta = load_download_meta(filename)
+
+    # Only fetch the file if it has changed
+    headers = {}
+    if os.path.exists(filename):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # Resume a partial download if the file on the server hasn't changed since
+    offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    if offset > 0 and meta.get("part_validator"):
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = meta["part_validator"]
+
     start_spinner(f"Downloading {filename}")
     try:
-        response = requests.get(url)
-        try:
-            with open(filename, "wb") as file:
-                file.write(response.content)
-                stop_spinner("done")
-            logging.info(f"Downloaded {url} to {filename}.")
-        except IOError as e:
-            logging.error(f"Could not save {filename}. {e}. Abort!")
-            sys.exit(0)
+        with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 304:
+                # Record when it was checked in the meta file rather than touching the file, which would look like a change
+                meta["checked"] = time.time()
+                save_download_meta(filename, meta)
+                stop_spinner("not modified")
+                logging.info(f"{url} not modified since last download.")
+                return
+
+            # The partial download is already complete or no longer valid, so start again
+            if response.status_code == 416:
+                stop_spinner("restarting")
+                os.remove(part_filename)
+                return download_file(url, filename)
+
+            response.raise_for_status()
+
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if response.status_code == 206:
+                mode = "ab"
+            else:
+                mode = "wb"
+                offset = 0
+            meta["part_validator"] = etag or last_modified
+            save_download_meta(filename, meta)
+
+            # Expected size (not known if the response is compressed in transit)
+            expected_size = None
+            if response.headers.get("Content-Length") and not response.headers.get("Content-Encoding"):
+                expected_size = offset + int(response.headers["Content-Length"])
+
+            try:
+                with open(part_filename, mode) as file:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        file.write(chunk)
+            except IOError as e:
+                stop_spinner("failed")
+                logging.error(f"Could not save {filename}. {e}. Abort!")
+                sys.exit(0)
     except requests.exceptions.RequestException as e:
-        logging.error(f"Download failed from {url}. {e}. Abort!")
+        stop_spinner("failed")
+        logging.error(f"Download failed from {url}. {e}. Run again to resume. Abort!")
+        sys.exit(0)
+
+    # Integrity check
+    size = os.path.getsize(part_filename)
+    if expected_size is not None and size != expected_size:
+        stop_spinner("incomplete")
+        logging.error(f"Download of {url} is incomplete ({size} of {expected_size} bytes). Run again to resume. Abort!")
+        sys.exit(0)
+    if filename.endswith(".zip") and not zipfile.is_zipfile(part_filename):
+        os.remove(part_filename)
+        stop_spinner("failed")
+        logging.error(f"Downloaded {filename} is not a valid zip file. Abort!")
         sys.exit(0)
 
+    os.replace(part_filename, filename)
+    save_download_meta(filename, {"etag": etag, "last_modified": last_modified, "size": size})
+    stop_spinner("done")
+    logging.info(f"Downloaded {url} to {filename}.")
+
 
 # File checker
 def file_check(url, filename):
+    # Copy the file from the local mirror directory if it is there
+    if mirror is not None:
+        mirror_filename = os.path.join(mirror, filename)
+        if os.path.exists(mirror_filename):
+            if not os.path.exists(filename) or os.path.getmtime(mirror_filename) > os.path.getmtime(filename):
+                print(f"> Copying {filename} from {mirror}")
+                start_stage("download")
+                shutil.copy2(mirror_filename, filename)
+                stop_stage("download", rows_out=1)
+            else:
+                print(f"> Found {filename} from {mirror}. Skipping copy.")
+            return
+        print(f"> {filename} is not in {mirror}. Downloading...")
+
     # Check if the file exists
     if os.path.exists(filename):
-        # Get the last modified time of the file
-        last_modified_time = os.path.getmtime(filename)
+        # Get the last modified time of the file (or when it was last found to be unchanged)
+        last_modified_time = max(os.path.getmtime(filename), load_download_meta(filename).get("checked", 0))
         # Get the current time
         current_time = time.time()
         # Calculate the age of the file in seconds (1 day = 86400 seconds)
         file_age = current_time - last_modified_time
 
         if file_age > 86400:  # 86400 seconds in a day
-            print(f"> {filename} is older than a day. Redownloading...")
+            print(f"> {filename} is older than a day. Checking for changes...")
+            start_stage("download")
             download_file(url, filename)
+            stop_stage("download", rows_out=1)
         else:
             print(f"> Found recent {filename} file. Skipping redownload.")
     else:
         print(f"> {filename} does not exist. Downloading...")
+        start_stage("download")
         download_file(url, filename)
+        stop_stage("download", rows_out=1)
 
 
 # Download Reference File (this preloads state and county data which would otherwise take a long time to get from geocode.maps.co api)
@@ -452,16 +1152,10 @@ def download_reference_file():
         )
     if os.path.exists(ref_file):
         try:
-            with open(ref_file, "r", encoding="utf-8") as csv_file:
-                print(f"> Reading {ref_file}")
-                csv_reader = csv.DictReader(csv_file)
-                # Convert CSV to object
-                global ref_data
-                ref_data = []
-                for row in csv_reader:
-                    ref_data.append(row)
-        except IOError as e:
-            logging.error(f"Could not read {ref_file} into object. {e}")
+            global ref_data
+            ref_data = load_reference_snapshot(ref_file)
+        except (IOError, ValueError) as e:
+            logging.error(f"Could not load {ref_file}. {e}")
     else:
         logging.info(f"{ref_file} not found")
         print(f"> {ref_file} not found")
@@ -472,13 +1166,227 @@ def download_reference_file():
         download_reference_file()
 
 
+# ===== Reference Snapshot =====
+# The reference csv is compiled once into a binary snapshot which is memory mapped on later runs.
+# Layout: header, column names (json), then per row (sorted by lat, lng) the lat, lng, geonameid and
+# string offset arrays, a geonameid index (sorted ids and their row numbers), and the utf-8 rows.
+
+# (Bump the version to recompile snapshots made by an older version)
+snapshot_magic = b"WCREF002"
+snapshot_header = struct.Struct("<8sqqIII")
+
+
+# Snapshot file name for a reference csv file
+def get_snapshot_filename(ref_file):
+    return os.path.splitext(ref_file)[0] + ".snapshot"
+
+
+# Round a byte offset up to the next 8 byte boundary
+def align8(offset):
+    return (offset + 7) & ~7
+
+
+# Compile the reference csv into a snapshot file
+def compile_reference_snapshot(ref_file, snapshot_file):
+    start_spinner(f"Compiling {ref_file} into {snapshot_file}")
+    with open(ref_file, "r", encoding="utf-8", newline="") as csv_file:
+        csv_reader = csv.reader(csv_file)
+        columns = next(csv_reader)
+        lat_index = columns.index("lat")
+        lng_index = columns.index("lng")
+        geonameid_index = columns.index("geonameid") if "geonameid" in columns else None
+        rows = []
+        for row in csv_reader:
+            if len(row) != len(columns):
+                continue
+            geonameid = row[geonameid_index] if geonameid_index is not None else ""
+            rows.append(
+                (
+                    float(row[lat_index]),
+                    float(row[lng_index]),
+                    int(geonameid) if geonameid.isdigit() else -1,
+                    "\t".join(field.replace("\t", " ") for field in row).encode("utf-8"),
+                )
+            )
+    rows.sort(key=lambda row: (row[0], row[1]))
+    count = len(rows)
+
+    offsets = array.array("I", [0])
+    for row in rows:
+        offsets.append(offsets[-1] + len(row[3]))
+    geonameid_index_rows = sorted((row[2], i) for i, row in enumerate(rows) if row[2] >= 0)
+    columns_json = json.dumps(columns).encode("utf-8")
+
+    source = os.stat(ref_file)
+    temp_file = snapshot_file + ".part"
+    with open(temp_file, "wb") as file:
+        file.write(snapshot_header.pack(snapshot_magic, source.st_size, source.st_mtime_ns, count, len(geonameid_index_rows), len(columns_json)))
+        file.write(columns_json)
+        file.write(b"\0" * (align8(snapshot_header.size + len(columns_json)) - snapshot_header.size - len(columns_json)))
+        array.array("d", (row[0] for row in rows)).tofile(file)
+        array.array("d", (row[1] for row in rows)).tofile(file)
+        array.array("q", (row[2] for row in rows)).tofile(file)
+        array.array("q", (geonameid for geonameid, i in geonameid_index_rows)).tofile(file)
+        offsets.tofile(file)
+        array.array("I", (i for geonameid, i in geonameid_index_rows)).tofile(file)
+        for row in rows:
+            file.write(row[3])
+    os.replace(temp_file, snapshot_file)
+    stop_spinner(f"{count} rows")
+
+
+# Read only view of a memory mapped reference snapshot
+class ReferenceSnapshot:
+    def __init__(self, snapshot_file):
+        with open(snapshot_file, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+        magic, self.source_size, self.source_mtime, self.count, geonameid_count, columns_length = snapshot_header.unpack_from(view)
+        if magic != snapshot_magic:
+            raise ValueError(f"{snapshot_file} is not a reference snapshot")
+        position = snapshot_header.size
+        end = position + columns_length
+        self.columns = json.loads(bytes(view[position:end]))
+        position = align8(end)
+
+        # Slice the arrays straight out of the mapped file (no copies are made)
+        def take(format, length, size):
+            nonlocal position
+            section = view[position : position + length * size].cast(format)
+            position += length * size
+            return section
+
+        self.lats = take("d", self.count, 8)
+        self.lngs = take("d", self.count, 8)
+        self.geonameids = take("q", self.count, 8)
+        self.geonameid_keys = take("q", geonameid_count, 8)
+        self.offsets = take("I", self.count + 1, 4)
+        self.geonameid_rows = take("I", geonameid_count, 4)
+        self.strings = view[position:]
+        self.countries = None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.row(i)
+
+    # Decode a row into a dict keyed by the csv column names
+    def row(self, i):
+        values = bytes(self.strings[self.offsets[i] : self.offsets[i + 1]]).decode("utf-8").split("\t")
+        return dict(zip(self.columns, values))
+
+    # Decode a row if its country is included (all countries are included unless a country list is set)
+    def allowed_row(self, i):
+        item = self.row(i)
+        if self.countries is None or item["country"].lower() in self.countries:
+            return item
+        return None
+
+    # Find a row by exact coordinates (the last one in the csv if there are duplicates, as rows are sorted stably)
+    def get(self, key, default=None):
+        lat, lng = key
+        found = default
+        i = bisect.bisect_left(self.lats, lat)
+        while i < self.count and self.lats[i] == lat:
+            if self.lngs[i] == lng:
+                item = self.allowed_row(i)
+                if item is not None:
+                    found = item
+            i += 1
+        return found
+
+    # Find a row by geonameid
+    def get_by_geonameid(self, geonameid, default=None):
+        i = bisect.bisect_left(self.geonameid_keys, geonameid)
+        if i < len(self.geonameid_keys) and self.geonameid_keys[i] == geonameid:
+            item = self.allowed_row(self.geonameid_rows[i])
+            if item is not None:
+                return item
+        return default
+
+    # Row numbers with a latitude between lat_min and lat_max (inclusive)
+    def rows_between(self, lat_min, lat_max):
+        return range(bisect.bisect_left(self.lats, lat_min), bisect.bisect_right(self.lats, lat_max))
+
+
+# Open the snapshot for a reference csv, compiling it first if it is missing or older than the csv
+def load_reference_snapshot(ref_file):
+    snapshot_file = get_snapshot_filename(ref_file)
+    source = os.stat(ref_file)
+    if os.path.exists(snapshot_file):
+        try:
+            snapshot = ReferenceSnapshot(snapshot_file)
+            if snapshot.source_size == source.st_size and snapshot.source_mtime == source.st_mtime_ns:
+                print(f"> Using {snapshot_file}")
+                return snapshot
+        except (ValueError, struct.error) as e:
+            logging.warning(f"Could not open {snapshot_file}, recompiling. {e}")
+    compile_reference_snapshot(ref_file, snapshot_file)
+    return ReferenceSnapshot(snapshot_file)
+
+
+# ===== Zip Reader =====
+
+
+# Size of the chunks a file inside a zip is decompressed in
+zip_chunk_size = 1024 * 1024
+
+
+# Stream a file inside a zip in chunks of whole lines (the last chunk may not end with a newline), decompressing as it
+# goes instead of reading the whole file into memory. The time spent decompressing is recorded as the unzip stage.
+def stream_zip_chunks(filename_zip, filename_txt, chunk_size=zip_chunk_size):
+    unzip_wall = 0.0
+    unzip_cpu = 0.0
+    line_count = 0
+    with zipfile.ZipFile(filename_zip, "r") as zip_ref:
+        with zip_ref.open(filename_txt) as f:
+            rest = b""
+            while True:
+                wall_start = time.perf_counter()
+                cpu_start = time.process_time()
+                chunk = f.read(chunk_size)
+                unzip_wall += time.perf_counter() - wall_start
+                unzip_cpu += time.process_time() - cpu_start
+                if not chunk:
+                    break
+                end = chunk.rfind(b"\n") + 1
+                if end == 0:
+                    rest += chunk
+                    continue
+                line_count += chunk.count(b"\n", 0, end)
+                yield rest + chunk[:end]
+                rest = chunk[end:]
+            if rest:
+                line_count += 1
+                yield rest
+    record_nested_stage("unzip", unzip_wall, unzip_cpu, line_count, line_count)
+
+
+# Stream lines from a file inside a zip
+def stream_zip_lines(filename_zip, filename_txt):
+    for chunk in stream_zip_chunks(filename_zip, filename_txt):
+        lines = chunk.split(b"\n")
+        last = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+        if last:
+            yield last
+
+
+# Get the uncompressed size of a file inside a zip (used as the progress bar total)
+def get_zip_member_size(filename_zip, filename_txt):
+    with zipfile.ZipFile(filename_zip, "r") as zip_ref:
+        return zip_ref.getinfo(filename_txt).file_size
+
+
 # ===== Cities Dataset =====
 
 
 # Download Cities Dataset
 def download_cities_dataset(population_threshold):
     global cities_dataset
-    global total_items_in_cities_dataset
 
     filename_txt = f"cities{population_threshold}.txt"
     filename_zip = f"cities{population_threshold}.zip"
@@ -486,55 +1394,82 @@ def download_cities_dataset(population_threshold):
 
     file_check(url, filename_zip)
 
-    # Extract cities dataset zip
-    start_spinner(f"Reading: {filename_txt} from {filename_zip}")
+    # The cities dataset is streamed from the zip when it is combined
     if os.path.exists(filename_zip):
-        with zipfile.ZipFile(filename_zip, "r") as zip_ref:
-            with zip_ref.open(filename_txt) as f:
-                cities_dataset = f.readlines()
-                total_items_in_cities_dataset = sum(1 for _ in cities_dataset)
-                stop_spinner("done")
+        cities_dataset = (filename_zip, filename_txt)
+
+
+# Compact record for a city in the combined dataset. Only the columns used by the script are kept,
+# repeated strings are interned, and country info is a dict shared by every city in the country.
+class City:
+    __slots__ = (
+        "geonameid",
+        "name",
+        "asciiname",
+        "alternatenames",
+        "latitude",
+        "longitude",
+        "feature_code",
+        "country_code",
+        "admin1_code",
+        "admin2_code",
+        "population",
+        "elevation",
+        "timezone",
+        "country",
+        "state",
+        "county",
+    )
+
+    def __init__(self, **fields):
+        self.country = {}
+        self.state = ""
+        self.county = ""
+        for key, value in fields.items():
+            setattr(self, key, value)
 
 
 # Combine Cities Dataset
 def combine_cities_dataset():
+    global total_items_in_cities_dataset
     print("\n> Adding cities to combined dataset...")
+    start_stage("cities_join")
+    unzipped_lines = get_stage_rows("unzip")[1]
+    cities_before = len(combined_dataset)
+
+    filename_zip, filename_txt = cities_dataset
 
     # Progress bar
-    totalItems = sum(1 for _ in cities_dataset)
+    totalBytes = get_zip_member_size(filename_zip, filename_txt)
     manager = enlighten.get_manager()
-    progress_bar = manager.counter(total=totalItems, desc="Adding", unit="city")
+    progress_bar = manager.counter(total=totalBytes, desc="Adding", unit="bytes")
 
     # Add cities data to combined dataset
-    for line in cities_dataset:
+    for line in stream_zip_lines(filename_zip, filename_txt):
         fields = line.decode("utf-8").strip().split("\t")
 
         # Create an item for the town/city
-        combined_dataset[fields[0]] = {
-            "geonameid": int(fields[0]),
-            "name": fields[1],
-            "asciiname": fields[2],
-            "alternatenames": {},  # fields[3].split(',') if fields[3] else [],
-            "latitude": float(fields[4]),
-            "longitude": float(fields[5]),
-            "feature_class": fields[6],
-            "feature_code": fields[7],
-            "country_code": fields[8],
-            "cc2": fields[9],
-            "admin1_code": fields[10],
-            "admin2_code": fields[11],
-            "admin3_code": fields[12],
-            "admin4_code": fields[13],
-            "population": int(fields[14]) if fields[14] else "",
-            "elevation": int(fields[15]) if fields[15] else "",
-            "dem": float(fields[16]) if fields[16] else None,
-            "timezone": fields[17],
-            "modification_date": fields[18],
-        }
+        combined_dataset[fields[0]] = City(
+            geonameid=int(fields[0]),
+            name=fields[1],
+            asciiname=fields[2],
+            alternatenames={} if include_altnames or (autocomplete and autocompleteLanguages) else None,
+            latitude=float(fields[4]),
+            longitude=float(fields[5]),
+            feature_code=sys.intern(fields[7]),
+            country_code=sys.intern(fields[8]),
+            admin1_code=sys.intern(fields[10]),
+            admin2_code=sys.intern(fields[11]),
+            population=int(fields[14]) if fields[14] else "",
+            elevation=int(fields[15]) if fields[15] else "",
+            timezone=sys.intern(fields[17]),
+        )
 
-        progress_bar.update()
+        progress_bar.update(len(line))
     progress_bar.close()
     manager.stop()
+    total_items_in_cities_dataset = len(combined_dataset)
+    stop_stage("cities_join", get_stage_rows("unzip")[1] - unzipped_lines, len(combined_dataset) - cities_before)
     print("\n")
 
 
@@ -564,59 +1499,85 @@ def download_country_info_dataset():
 # Combine Country Info Dataset
 def combine_country_info_dataset():
     print("> Adding country info to combined dataset...")
+    start_stage("country_join")
+    matched_cities = 0
 
-    # Progress bar
-    totalItems = sum(1 for _ in countryInfoDataset)
-    manager = enlighten.get_manager()
-    progress_bar = manager.counter(total=totalItems, desc="Adding", unit="name")
-
-    # Add alt names to combined dataset
+    # Index country info by ISO code
+    country_info = {}
     for line in countryInfoDataset:
         fields = line.strip().split("\t")
 
         # if len(fields) < 17:
-        # progress_bar.update()
         # continue
 
-        iso = fields[0]
+        iso = sys.intern(fields[0])
         # iso3 = fields[1]
         # isoNumeric = fields[2]
         # fips = fields[3]
-        country_name = fields[4]
-        capital = fields[5]
-        area = fields[6]
         # population = fields[7]
-        continent = fields[8]
         # tld = fields[9]
-        currencyCode = fields[10]
-        currencyName = fields[11]
-        phone = fields[12]
         # postalCodeFormat = fields[13]
         # postalCodeRegex = fields[14]
-        languages = fields[15]
-        geonameid = fields[16]
-        neighbours = fields[17] if len(fields) > 17 else ""
-
-        # Append alt name
-        for geonameid, value in combined_dataset.items():
-            country_code = combined_dataset[geonameid]["country_code"]
-            if country_code == iso:
-                combined_dataset[geonameid]["country_name"] = country_name
-                combined_dataset[geonameid]["capital"] = capital
-                combined_dataset[geonameid]["area"] = area
-                combined_dataset[geonameid]["continent"] = continent
-                combined_dataset[geonameid]["currency_code"] = currencyCode
-                combined_dataset[geonameid]["currency_name"] = currencyName
-                combined_dataset[geonameid]["phone"] = phone
-                combined_dataset[geonameid]["languages"] = languages
-                combined_dataset[geonameid]["neighbours"] = neighbours
+        # geonameid = fields[16]
+        country_info[iso] = {
+            "country_name": fields[4],
+            "capital": fields[5],
+            "area": fields[6],
+            "continent": fields[8],
+            "currency_code": fields[10],
+            "currency_name": fields[11],
+            "phone": fields[12],
+            "languages": fields[15],
+            "neighbours": fields[17] if len(fields) > 17 else "",
+        }
+
+    # Progress bar
+    totalItems = len(combined_dataset)
+    manager = enlighten.get_manager()
+    progress_bar = manager.counter(total=totalItems, desc="Adding", unit="city")
+
+    # Add country info to combined dataset in a single pass (each city shares its country's dict)
+    for value in combined_dataset.values():
+        info = country_info.get(value.country_code)
+        if info is not None:
+            value.country = info
+            matched_cities += 1
 
         progress_bar.update()
     progress_bar.close()
     manager.stop()
+    stop_stage("country_join", len(combined_dataset), matched_cities)
     print("\n")
 
 
+# ===== Admin Codes Dataset =====
+
+admin1_names = {}
+admin2_names = {}
+
+
+# Download Admin Codes Datasets (state and county names keyed by "country.admin1" and "country.admin1.admin2")
+def download_admin_codes_datasets():
+    for filename, names in [("admin1CodesASCII.txt", admin1_names), ("admin2Codes.txt", admin2_names)]:
+        url = f"https://download.geonames.org/export/dump/{filename}"
+
+        file_check(url, filename)
+
+        if os.path.exists(filename):
+            with open(filename, "r", encoding="utf-8") as file:
+                for line in file:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) >= 2:
+                        names[fields[0]] = fields[1]
+
+
+# Get the state and county names for a city from its admin codes
+def get_admin_names(city):
+    state = admin1_names.get(f"{city.country_code}.{city.admin1_code}", "")
+    county = admin2_names.get(f"{city.country_code}.{city.admin1_code}.{city.admin2_code}", "") if city.admin2_code else ""
+    return state, county
+
+
 # ===== Alternative Place Names Dataset =====
 
 
@@ -629,235 +1590,754 @@ def download_alt_names_dataset():
 
     file_check(url, filename_zip)
 
+    # The alternative names dataset is streamed from the zip when it is combined
     if os.path.exists(filename_zip):
-        start_spinner(f"Reading {filename_txt} from {filename_zip}")
-        with zipfile.ZipFile(filename_zip, "r") as zip_ref:
-            with zip_ref.open(filename_txt) as f:
-                alternative_names_dataset = f.readlines()
-                stop_spinner("done")
+        alternative_names_dataset = (filename_zip, filename_txt)
+
+
+# Alternative name types that are not place names
+excluded_altname_languages = {"link", "wkdt", "unlc", "post", "iata"}
+
+# Size of the chunks of the alternate names dataset each worker process parses
+altname_chunk_size = 8 * 1024 * 1024
+# Geonameids (as bytes) of the cities in the combined dataset, set in each worker process
+altname_worker_geonameids = None
 
 
 # Combine Alternative Names Dataset
 def combine_altname_dataset(alternative_names_dataset):
     print("> Adding alternative names to combined dataset...")
+    start_stage("altnames_join")
+    unzipped_lines = get_stage_rows("unzip")[1]
+    added_names = 0
+    worker_cpu_seconds = 0.0
+
+    filename_zip, filename_txt = alternative_names_dataset
 
     # Progress bar
-    totalItems = sum(1 for _ in alternative_names_dataset)
+    totalBytes = get_zip_member_size(filename_zip, filename_txt)
     manager = enlighten.get_manager()
-    progress_bar = manager.counter(total=totalItems, desc="Adding", unit="name")
+    progress_bar = manager.counter(total=totalBytes, desc="Adding", unit="bytes")
+
+    geonameids = {geonameid.encode("utf-8") for geonameid in combined_dataset}
+    workers = args.altnames_workers if args.altnames_workers > 0 else (os.cpu_count() or 1)
+    if workers > 1:
+        # Parse chunks of the file in worker processes, adding their names in file order so the result is the same as parsing in one process
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_altname_worker_geonameids, initargs=(geonameids,)) as executor:
+            pending = deque()
+            for chunk in stream_zip_chunks(filename_zip, filename_txt, altname_chunk_size):
+                pending.append((executor.submit(parse_altname_chunk, chunk), len(chunk)))
+                # Only keep a few chunks in flight per worker to bound memory
+                while len(pending) > workers * 2 or (pending and pending[0][0].done()):
+                    future, size = pending.popleft()
+                    names, cpu_seconds = future.result()
+                    added_names += add_altnames(names)
+                    worker_cpu_seconds += cpu_seconds
+                    progress_bar.update(size)
+            while pending:
+                future, size = pending.popleft()
+                names, cpu_seconds = future.result()
+                added_names += add_altnames(names)
+                worker_cpu_seconds += cpu_seconds
+                progress_bar.update(size)
+    else:
+        for chunk in stream_zip_chunks(filename_zip, filename_txt):
+            added_names += add_altnames(parse_altname_lines(chunk, geonameids))
+            progress_bar.update(len(chunk))
 
-    # Add alt names to combined dataset
-    for line in alternative_names_dataset:
-        fields = line.decode("utf-8").strip().split("\t")
+    progress_bar.close()
+    manager.stop()
+    stop_stage("altnames_join", get_stage_rows("unzip")[1] - unzipped_lines, added_names, worker_cpu_seconds)
+    print("\n")
 
-        if len(fields) < 4:
-            progress_bar.update()
-            continue
 
-        geonameid = fields[1]
-        isolanguage = fields[2]
-        alternate_name = fields[3]
+# Parse lines of the alternate names dataset, returning (geonameid, language, name) for each name of the wanted places
+# (a set of geonameids as bytes) in file order
+def parse_altname_lines(chunk, geonameids):
+    names = []
+    for line in chunk.split(b"\n"):
+        # Drop lines early if the geonameid is not in the cities dataset
+        fields = line.split(b"\t", 4)
+        if len(fields) < 4 or fields[1] not in geonameids:
+            continue
 
+        isolanguage = fields[2].decode("utf-8")
         if isolanguage == "":
             isolanguage = "?"
+        if isolanguage in excluded_altname_languages:
+            continue
 
-        # Append alt name
-        if isolanguage not in ["link", "wkdt", "unlc", "post", "iata"]:
-            if geonameid in combined_dataset:
-                if isolanguage not in combined_dataset[geonameid]["alternatenames"]:
-                    combined_dataset[geonameid]["alternatenames"][isolanguage] = []
-                combined_dataset[geonameid]["alternatenames"][isolanguage].append(
-                    alternate_name
-                )
+        names.append((fields[1].decode("utf-8"), isolanguage, fields[3].decode("utf-8").strip()))
+    return names
 
-        progress_bar.update()
-    progress_bar.close()
-    manager.stop()
-    print("\n")
 
+# Set the wanted geonameids in a worker process
+def set_altname_worker_geonameids(geonameids):
+    global altname_worker_geonameids
+    altname_worker_geonameids = geonameids
+    # CTRL+C is handled by the main process (workers would otherwise run signal_handler too)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-# ===== GeoCode API =====
 
-if not "geocode_lookup_count" in globals():
-    geocode_lookup_count = 0
-county = ""
-state = ""
+# Parse a chunk in a worker process, returning the names and the CPU time taken
+def parse_altname_chunk(chunk):
+    cpu_start = time.process_time()
+    names = parse_altname_lines(chunk, altname_worker_geonameids)
+    return names, time.process_time() - cpu_start
 
 
-def geocode_lookup(lat, lng):
-    global geocode_lookup_count
-    max_retries = 5
+# Append parsed alternate names to the cities in the combined dataset, returning how many were added
+def add_altnames(names):
+    for geonameid, isolanguage, alternate_name in names:
+        alternatenames = combined_dataset[geonameid].alternatenames
+        if isolanguage not in alternatenames:
+            alternatenames[isolanguage] = []
+        alternatenames[isolanguage].append(alternate_name)
+    return len(names)
 
-    # Get Geocode API Key
-    geocode_api_key = checkGeocodeKey()
 
-    # Construct the geocoding URL
-    geocode_url = (f"https://geocode.maps.co/reverse?lat={lat}&lon={lng}&api_key={geocode_api_key}")
+# ===== Lookup Cache =====
 
-    time.sleep(1)
+# Persistent cache of geocode, geo.fcc.gov and open meteo results, keyed by provider and coordinates
+cache_filename = "lookup_cache.db"
+cache_db = None
+cache_hits = {}
+cache_misses = {}
 
-    for attempt in range(max_retries + 1):
-        try:
-            if attempt > 0:
-                wait_time = 2**attempt  # Exponential backoff
-                time.sleep(wait_time)
 
-            # Perform the request with a timeout
-            response = requests.get(geocode_url, timeout=10)
+# Open (and create if required) the lookup cache
+def open_lookup_cache():
+    global cache_db
+    if cache_db is None:
+        cache_db = sqlite3.connect(cache_filename, isolation_level=None)
+        cache_db.execute("PRAGMA journal_mode=WAL")
+        cache_db.execute("PRAGMA synchronous=NORMAL")
+        cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS lookups (provider TEXT, lat TEXT, lng TEXT, result TEXT, updated REAL, PRIMARY KEY (provider, lat, lng))"
+        )
+    return cache_db
+
+
+# Normalize coordinates to GeoNames precision (5 decimal places)
+def cache_key(lat, lng):
+    return f"{float(lat):.5f}", f"{float(lng):.5f}"
+
+
+# Get a cached lookup result, or None if it is missing or expired
+def cache_get(provider, lat, lng):
+    if disableCache:
+        return None
+    row = open_lookup_cache().execute(
+        "SELECT result, updated FROM lookups WHERE provider = ? AND lat = ? AND lng = ?",
+        (provider, *cache_key(lat, lng)),
+    ).fetchone()
+    if row is None or time.time() - row[1] > args.cache_ttl * 86400:
+        cache_misses[provider] = cache_misses.get(provider, 0) + 1
+        return None
+    cache_hits[provider] = cache_hits.get(provider, 0) + 1
+    return json.loads(row[0])
+
+
+# Save a lookup result to the cache
+def cache_put(provider, lat, lng, result, replace=True):
+    if disableCache or result is None:
+        return
+    open_lookup_cache().execute(
+        f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO lookups VALUES (?, ?, ?, ?, ?)",
+        (provider, *cache_key(lat, lng), json.dumps(result), time.time()),
+    )
 
-            # Handle specific HTTP error codes
-            if response.status_code == 429:
-                print("! Rate limit exceeded. Saving resume file and stopping...")
-                logging.warning("Rate limit exceeded. Saving resume file and stopping...")
-                saveAndStop()
-                continue
 
-            if response.status_code == 503:
-                print("! Service unavailable. Retrying...")
-                logging.error("Service unavailable. Retrying...")
-                continue
+# Print and log cache hit/miss statistics for a provider
+def print_cache_stats(provider):
+    if disableCache:
+        return
+    hits = cache_hits.get(provider, 0)
+    misses = cache_misses.get(provider, 0)
+    print(f"Cache ({provider}): {hits} hits, {misses} misses")
+    logging.info(f"Cache ({provider}): {hits} hits, {misses} misses")
 
-            # Raise an exception for other HTTP errors
-            response.raise_for_status()
 
-            # Parse the JSON response
-            geocode_data = response.json()
-            address = geocode_data.get("address", {})
+# Pre-warm the lookup cache from the reference file (existing entries are kept)
+def warm_lookup_cache():
+    if not ref_data:
+        download_reference_file()
+    start_spinner(f"Warming {cache_filename} from reference file")
+    db = open_lookup_cache()
+    count = 0
+    db.execute("BEGIN")
+    for item in ref_data:
+        if item["state"] or item["county"]:
+            cache_put("geocode", item["lat"], item["lng"], [item["state"], item["county"]], replace=False)
+            count += 1
+        if item.get("elevation"):
+            cache_put("open_meteo", item["lat"], item["lng"], int(float(item["elevation"])), replace=False)
+            count += 1
+    db.execute("COMMIT")
+    stop_spinner(f"{count} entries")
+
+
+# ===== Lookup Scheduler =====
+
+
+# Token bucket rate limiter shared by all worker threads of a provider
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until a request is allowed
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            wait_or_stop(wait_time)
+
+    # Change the rate (used to slow down when a provider is rate limiting)
+    def set_rate(self, rate):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.capacity = max(1, rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+
+rate_limiters = {}
+provider_clients = {}
+
+
+# Create a rate limiter for each provider from the provider limits (and new clients, so they use the new limiters)
+def reset_rate_limiters():
+    rate_limiters.clear()
+    rate_limiters.update({provider: TokenBucket(limits["rate"]) for provider, limits in provider_limits.items()})
+    provider_clients.clear()
+
+
+reset_rate_limiters()
+lookup_count_lock = threading.Lock()
+
+
+# Raised when a lookup on a worker thread needs the main thread to save and stop
+class StopLookups(Exception):
+    pass
+
+
+# Set when the build is stopping, to wake lookups waiting on a backoff, rate limit or open circuit
+lookups_stopping = threading.Event()
+
+
+# Wait for a number of seconds, raising StopLookups if the build stops in the meantime
+def wait_or_stop(seconds):
+    if lookups_stopping.wait(seconds):
+        raise StopLookups()
+
+
+# Wake every waiting lookup so the worker threads finish and the build can stop
+def stop_lookups():
+    lookups_stopping.set()
+    for client in list(provider_clients.values()):
+        with client.condition:
+            client.probing = False
+            client.condition.notify_all()
+
+
+# ===== Provider Client =====
+
+# Retries of a request before the lookup goes to the dead letter queue
+provider_max_retries = 5
+# Longest backoff between retries in seconds (without a Retry-After)
+provider_backoff_cap = 60
+# Longest a lookup waits for a Retry-After, and longest a provider can be down, before the build stops to resume later
+provider_max_wait = 300
+# Failed requests in a row that open the circuit, and how long it stays open
+circuit_failure_threshold = 5
+circuit_cooldown = 30
+# Slowest the rate is lowered to when a provider is rate limiting (requests per second)
+provider_min_rate = 0.05
+
+
+# Raised when a lookup fails for good (the lookup goes to the dead letter queue)
+class LookupFailed(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
 
-            # Extract state and county with fallback
-            state = address.get("state", "")
-            county = address.get("county", "")
 
-            geocode_lookup_count += 1
+# Seconds to wait from a Retry-After header (either seconds or a date), or None
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
 
-            return [state, county]
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# HTTP client for a provider shared by its worker threads. It keeps connections alive, backs off on 429s (following
+# Retry-After and halving the request rate, which then recovers a step at a time), and opens a circuit after repeated
+# failures so no requests are sent until the provider recovers (then a single request tests it).
+class ProviderClient:
+    def __init__(self, provider, rate_limiter, workers):
+        self.provider = provider
+        self.rate_limiter = rate_limiter
+        self.max_rate = rate_limiter.rate
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(1, workers))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.condition = threading.Condition()
+        self.failures = 0
+        self.open_until = 0.0
+        self.half_open = False
+        self.probing = False
+        self.down_since = None
+        self.stopped = False
+
+    # Wait until the circuit allows a request (only one request is sent while testing if the provider has recovered).
+    # Returns True if this request is the one testing the provider.
+    def wait_for_circuit(self):
+        with self.condition:
+            while True:
+                if self.stopped or lookups_stopping.is_set():
+                    raise StopLookups()
+                if self.down_since is not None and time.monotonic() - self.down_since > provider_max_wait:
+                    self.stop(f"{self.provider} has been unavailable for over {provider_max_wait} seconds")
+                wait_time = self.open_until - time.monotonic()
+                if wait_time > provider_max_wait:
+                    self.stop(f"{self.provider} is unavailable for another {wait_time:.0f} seconds")
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                elif self.half_open and self.probing:
+                    self.condition.wait()
+                else:
+                    # The test request is marked with the thread sending it
+                    self.probing = threading.get_ident() if self.half_open else False
+                    return bool(self.probing)
+
+    # The provider can't be used for now (every other lookup would fail too), so save and stop to resume later
+    def stop(self, message):
+        with self.condition:
+            if not self.stopped:
+                print(f"! {message}")
+                logging.error(message)
+            self.stopped = True
+            self.probing = False
+            self.condition.notify_all()
+        saveAndStop()
+
+    # The provider answered, so close the circuit and speed back up
+    def record_success(self):
+        with self.condition:
+            if self.half_open:
+                print(f"> {self.provider} has recovered")
+                logging.info(f"{self.provider} circuit closed")
+            self.failures = 0
+            self.half_open = False
+            self.probing = False
+            self.down_since = None
+            self.condition.notify_all()
+        if self.rate_limiter.rate < self.max_rate:
+            self.rate_limiter.set_rate(min(self.max_rate, self.rate_limiter.rate + self.max_rate / 20))
+
+    # The provider failed, so open the circuit after too many failures in a row (or if the test request failed)
+    def record_failure(self, retry_after=None):
+        with self.condition:
+            self.failures += 1
+            if self.half_open or self.failures >= circuit_failure_threshold:
+                cooldown = max(circuit_cooldown, retry_after or 0)
+                self.open_until = max(self.open_until, time.monotonic() + cooldown)
+                if not self.half_open:
+                    print(f"! {self.provider} is failing. Pausing requests for {cooldown:.0f} seconds...")
+                    logging.error(f"{self.provider} circuit opened for {cooldown:.0f} seconds")
+                    self.down_since = time.monotonic()
+                self.half_open = True
+            self.probing = False
+            self.condition.notify_all()
+
+    # The test request ended without an answer either way (e.g. the build is stopping), so let another request test it
+    def end_probe(self):
+        with self.condition:
+            if self.probing == threading.get_ident():
+                self.probing = False
+                self.condition.notify_all()
+
+    # The provider is rate limiting, so pause every worker for the Retry-After and halve the rate
+    def record_rate_limited(self, retry_after):
+        with self.condition:
+            self.open_until = max(self.open_until, time.monotonic() + retry_after)
+            self.probing = False
+            self.condition.notify_all()
+        self.rate_limiter.set_rate(max(provider_min_rate, self.rate_limiter.rate / 2))
+
+    # Send a GET request, retrying until it succeeds. Raises LookupFailed if it fails for good.
+    def get(self, url):
+        error = None
+        for attempt in range(provider_max_retries + 1):
+            if attempt > 0:
+                record_provider_retry(self.provider)
 
-        except RequestException as e:
-            logging.error(f"Request error for coordinates {lat},{lng}: {e}")
+            probe = self.wait_for_circuit()
+            try:
+                self.rate_limiter.acquire()
+
+                request_start = time.perf_counter()
+                try:
+                    response = self.session.get(url, timeout=10)
+                except requests.exceptions.RequestException as e:
+                    record_provider_request(self.provider, time.perf_counter() - request_start, None)
+                    logging.error(f"{self.provider} request error: {e}")
+                    error = str(e)
+                    self.record_failure()
+                    wait_or_stop(random.uniform(0, min(provider_backoff_cap, 2**attempt)))
+                    continue
+                record_provider_request(self.provider, time.perf_counter() - request_start, response.status_code)
 
-            # Different handling for different types of request exceptions
-            if isinstance(e, HTTPError):
-                if e.response.status_code == 429:
-                    logging.warning("Rate limit exceeded. Backing off...")
-                    print("> Rate limit exceeded. Backing off...")
-                    saveAndStop()
-                elif e.response.status_code == 503:
-                    logging.error("Service unavailable. Retrying...")
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if response.status_code == 429:
+                    logging.warning(f"{self.provider} rate limit exceeded. Backing off...")
+                    error = "429 Too Many Requests"
+                    self.record_rate_limited(retry_after if retry_after is not None else min(provider_backoff_cap, 2**attempt))
+                    continue
 
-            # If it's the last attempt, re-raise the exception
-            if attempt == max_retries:
-                logging.error(f"Failed to retrieve geocode after {max_retries} attempts")
-                saveAndStop()
+                if response.status_code >= 500:
+                    logging.error(f"{self.provider} returned {response.status_code}. Retrying...")
+                    error = f"{response.status_code} {response.reason}"
+                    self.record_failure(retry_after)
+                    wait_or_stop(retry_after if retry_after is not None else random.uniform(0, min(provider_backoff_cap, 2**attempt)))
+                    continue
 
-#===== Geo FCC API =====
+                # A missing or rejected api key fails every lookup
+                if response.status_code in (401, 403):
+                    self.stop(f"{self.provider} refused the request ({response.status_code} {response.reason}). Check the api key")
+
+                # Other errors (e.g. a bad coordinate) won't succeed if retried
+                self.record_success()
+                if response.status_code >= 400:
+                    raise LookupFailed(f"{response.status_code} {response.reason}", response.status_code)
+                return response
+            finally:
+                if probe:
+                    self.end_probe()
+
+        raise LookupFailed(f"Failed after {provider_max_retries + 1} attempts ({error})")
 
-if not "geo_fcc_lookup_count" in globals():
-    geo_fcc_lookup_count = 0
 
-def geo_fcc_lookup(lat, lng):
-    global geo_fcc_lookup_count
-    max_retries = 5
+provider_clients_lock = threading.Lock()
 
-    # Construct the geocoding URL
-    geo_fcc_url = (f"https://geo.fcc.gov/api/census/area?lat={lat}&lon={lng}&censusYear=2020&format=json")
 
-    time.sleep(1)
+# Get the client of a provider, creating it on first use
+def get_provider_client(provider):
+    with provider_clients_lock:
+        client = provider_clients.get(provider)
+        if client is None:
+            client = provider_clients[provider] = ProviderClient(provider, rate_limiters[provider], provider_limits[provider]["workers"])
+        return client
+
+
+# ===== Dead Letter Queue =====
+
+# Lookups that failed for good are saved here so the build can carry on. Running again with --resume retries them.
+dead_letter_filename = "dead_letters.jsonl"
+dead_letter_file = None
+dead_letter_counts = {}
+
+
+# Save lookups that failed for good
+def write_dead_letters(provider, batch, error):
+    global dead_letter_file
+    if dead_letter_file is None:
+        dead_letter_file = open(dead_letter_filename, "w", encoding="utf-8")
+    for key, (lat, lng) in batch:
+        dead_letter_file.write(json.dumps([provider, key, lat, lng, str(error)], ensure_ascii=False) + "\n")
+    dead_letter_file.flush()
+    dead_letter_counts[provider] = dead_letter_counts.get(provider, 0) + len(batch)
+    logging.error(f"{provider} lookup failed for {len(batch)} places: {error}")
+
+
+# Print how many lookups of a provider failed
+def print_dead_letter_stats(provider):
+    if dead_letter_counts.get(provider):
+        print(f"! {provider} lookups failed: {dead_letter_counts[provider]} (saved to {dead_letter_filename})")
+
+
+# Print how to retry the failed lookups, returning True if there were any
+def report_dead_letters():
+    total = sum(dead_letter_counts.values())
+    if total == 0:
+        return False
+    dead_letter_file.close()
+    print(f"! {total} lookups failed and are saved in {dead_letter_filename}. Run again with --resume to retry them.")
+    logging.warning(f"{total} lookups failed and are saved in {dead_letter_filename}")
+    return True
+
+
+# ===== Lookup Coalescing =====
+
+coalesce_counts = {}
+
+
+# Group lookup items so places with the same coordinates, or within the coalesce radius of the first place in a
+# group, share one lookup. Returns a list of (coordinates, [(key, coordinates), ...]) in the order the groups were started.
+def coalesce_lookups(items, radius=0):
+    groups = []
+    exact_groups = {}
+    grid = {}
+    cell_size = radius / 111320  # 1 degree of latitude is about 111320 metres
+
+    for key, coordinates in items:
+        group = exact_groups.get(coordinates)
+
+        # Look for a group started within the radius in the surrounding grid cells
+        if group is None and radius > 0:
+            lat, lng = coordinates
+            row = math.floor(lat / cell_size)
+            column = math.floor(lng / cell_size)
+            lng_cells = math.ceil(1 / max(math.cos(math.radians(lat)), 0.01))
+            nearest_distance = radius
+            for cell_row in range(row - 1, row + 2):
+                for cell_column in range(column - lng_cells, column + lng_cells + 1):
+                    for candidate in grid.get((cell_row, cell_column), ()):
+                        distance = haversine_distance(lat, lng, *candidate[0])
+                        if distance <= nearest_distance:
+                            group = candidate
+                            nearest_distance = distance
+
+        if group is None:
+            group = (coordinates, [])
+            groups.append(group)
+            if radius > 0:
+                grid.setdefault((math.floor(coordinates[0] / cell_size), math.floor(coordinates[1] / cell_size)), []).append(group)
+        exact_groups[coordinates] = group
+        group[1].append((key, coordinates))
+
+    return groups
+
+
+# Print how many lookups were saved by sharing lookups between places
+def print_coalesce_stats(provider):
+    places, lookups = coalesce_counts.get(provider, (0, 0))
+    if places > lookups:
+        print(f"Coalesced ({provider}): {places} places in {lookups} lookups ({places - lookups} lookups saved)")
+        logging.info(f"Coalesced ({provider}): {places} places in {lookups} lookups ({places - lookups} lookups saved)")
+
+
+# Run a lookup for each (key, (lat, lng)) item on a bounded worker pool, yielding (key, result) as they complete.
+# Places at the same coordinates (or within --coalesce_radius) share one lookup, and its result is yielded for each.
+# Journaled and cached results are yielded straight away, and new results are saved to the cache and journal.
+# With a batch_size, the lookup is called with a list of coordinates and returns a list of results.
+# Lookups that fail for good (or a LookupFailed in a batch's results) are saved to the dead letter queue instead of being yielded.
+def run_lookups(provider, lookup, items, batch_size=None):
+    workers = max(1, provider_limits[provider]["workers"])
+    groups = iter(coalesce_lookups(items, args.coalesce_radius))
+    pending = {}
+    cached = deque()
+
+    def submit_next():
+        batch = []
+        for coordinates, members in groups:
+            # Places looked up before the resume, or whose own coordinates are cached, don't need looking up again
+            remaining = []
+            for key, member_coordinates in members:
+                result = resume_journal.get((provider, key))
+                if result is None:
+                    result = cache_get(provider, *member_coordinates)
+                if result is not None:
+                    cached.append((key, result))
+                else:
+                    remaining.append((key, member_coordinates))
+            if not remaining:
+                continue
+
+            # The places nearby can share a cached result for the coordinates of the group (unless that was checked above)
+            result = cache_get(provider, *coordinates) if remaining[0][1] != coordinates else None
+            if result is not None:
+                cached.extend((key, result) for key, member_coordinates in remaining)
+                continue
 
-    for attempt in range(max_retries + 1):
-        try:
-            if attempt > 0:
-                wait_time = 2**attempt
-                time.sleep(wait_time)
+            places, lookups = coalesce_counts.get(provider, (0, 0))
+            coalesce_counts[provider] = (places + len(remaining), lookups + 1)
+            record_provider_coalesced(provider, len(remaining) - 1)
+            batch.append((coordinates, remaining))
+            if len(batch) >= (batch_size or 1):
+                break
+        if batch:
+            if batch_size:
+                future = executor.submit(lookup, [coordinates for coordinates, members in batch])
+            else:
+                future = executor.submit(lookup, *batch[0][0])
+            pending[future] = batch
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Only keep as many lookups queued as there are workers so a stop doesn't wait on a backlog
+        for _ in range(workers):
+            submit_next()
+        while pending or cached:
+            while cached:
+                yield cached.popleft()
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    results = future.result()
+                except StopLookups:
+                    for other in pending:
+                        other.cancel()
+                    saveAndStop()
+                except LookupFailed as e:
+                    # Carry on without these places (they keep their empty values)
+                    write_dead_letters(provider, [member for coordinates, members in batch for member in members], e)
+                    submit_next()
+                    continue
+                if not batch_size:
+                    results = [results]
+                for (coordinates, members), result in zip(batch, results):
+                    if isinstance(result, LookupFailed):
+                        write_dead_letters(provider, members, result)
+                        continue
+                    # Only the coordinates that were looked up are cached (the other places share an approximate result)
+                    cache_put(provider, *coordinates, result)
+                    for key, member_coordinates in members:
+                        write_journal(provider, key, result)
+                        yield key, result
+                submit_next()
 
-            # Perform the request with a timeout
-            response = requests.get(geo_fcc_url, timeout=10)
 
-            if response.status_code == 503:
-                print("! Service unavailable. Retrying...")
-                logging.error("Service unavailable. Retrying...")
-                continue
+# ===== GeoCode API =====
 
-            # Raise an exception for other HTTP errors
-            response.raise_for_status()
+if not "geocode_lookup_count" in globals():
+    geocode_lookup_count = 0
+county = ""
+state = ""
+
+
+def geocode_lookup(lat, lng):
+    global geocode_lookup_count
+
+    # Get Geocode API Key
+    geocode_api_key = checkGeocodeKey()
+
+    # Construct the geocoding URL
+    geocode_url = (f"{provider_urls['geocode']}/reverse?lat={lat}&lon={lng}&api_key={geocode_api_key}")
+
+    # Perform the request (retried by the client)
+    response = get_provider_client("geocode").get(geocode_url)
 
-            # Parse the JSON response and extract the county name
-            geocode_data = response.json()
-            county = geocode_data.get("results", [{}])[0].get("county_name", "")
+    # Parse the JSON response
+    try:
+        geocode_data = response.json()
+    except ValueError as e:
+        raise LookupFailed(f"Invalid response for coordinates {lat},{lng}: {e}")
+    address = geocode_data.get("address", {})
 
-            geo_fcc_lookup_count += 1
+    # Extract state and county with fallback
+    state = address.get("state", "")
+    county = address.get("county", "")
 
-            return county
+    with lookup_count_lock:
+        geocode_lookup_count += 1
 
-        except RequestException as e:
-            logging.error(f"Request error for coordinates {lat},{lng}: {e}")
+    return [state, county]
 
-            if isinstance(e, HTTPError):
-                if e.response.status_code == 503:
-                    logging.error("Service unavailable. Retrying...")
+#===== Geo FCC API =====
 
-            # If it's the last attempt, re-raise the exception
-            if attempt == max_retries:
-                logging.error(f"Failed to retrieve geocode after {max_retries} attempts")
-                saveAndStop()
+if not "geo_fcc_lookup_count" in globals():
+    geo_fcc_lookup_count = 0
 
+def geo_fcc_lookup(lat, lng):
+    global geo_fcc_lookup_count
 
-#===== Open Meteo API =====
+    # Construct the geocoding URL
+    geo_fcc_url = (f"{provider_urls['geo_fcc']}/api/census/area?lat={lat}&lon={lng}&censusYear=2020&format=json")
 
-if not "open_meteo_lookup_count" in globals():
-    open_meteo_lookup_count = 0
+    # Perform the request (retried by the client)
+    response = get_provider_client("geo_fcc").get(geo_fcc_url)
 
-def open_meteo_lookup(lat, lng):
-    global open_meteo_lookup_count
-    max_retries = 5
+    # Parse the JSON response and extract the county name
+    try:
+        geocode_data = response.json()
+    except ValueError as e:
+        raise LookupFailed(f"Invalid response for coordinates {lat},{lng}: {e}")
+    county = geocode_data.get("results", [{}])[0].get("county_name", "")
 
-    # Construct the open meteo URL
-    open_meteo_url = (f"https://api.open-meteo.com/v1/elevation?latitude={lat}&longitude={lng}")
+    with lookup_count_lock:
+        geo_fcc_lookup_count += 1
 
-    time.sleep(0.1)
+    return county
 
-    for attempt in range(max_retries + 1):
-        try:
-            if attempt > 0:
-                wait_time = 2**attempt
-                time.sleep(wait_time)
 
-            # Perform the request with a timeout
-            response = requests.get(open_meteo_url, timeout=10)
+#===== Open Meteo API =====
 
-            if response.status_code == 503:
-                print("! Service unavailable. Retrying...")
-                logging.error("Service unavailable. Retrying...")
-                continue
+if not "open_meteo_lookup_count" in globals():
+    open_meteo_lookup_count = 0
 
-            # Raise an exception for other HTTP errors
-            response.raise_for_status()
+# Maximum number of coordinates the open meteo elevation api accepts per request
+open_meteo_max_batch_size = 100
 
-            # Parse the JSON response and extract the elevation
-            open_meteo_data = response.json()
-            elevation = int(open_meteo_data["elevation"][0])
 
-            open_meteo_lookup_count += 1
+# Look up the elevations of a list of (lat, lng) coordinates in one request
+def open_meteo_lookup(coordinates):
+    global open_meteo_lookup_count
 
-            return elevation
+    # Construct the open meteo URL
+    latitudes = ",".join(str(lat) for lat, lng in coordinates)
+    longitudes = ",".join(str(lng) for lat, lng in coordinates)
+    open_meteo_url = (f"{provider_urls['open_meteo']}/v1/elevation?latitude={latitudes}&longitude={longitudes}")
 
-        except RequestException as e:
-            logging.error(f"Request error for coordinates {lat},{lng}: {e}")
+    # Perform the request (retried by the client)
+    try:
+        response = get_provider_client("open_meteo").get(open_meteo_url)
+    except LookupFailed as e:
+        # One bad coordinate fails the whole batch, so split it and fetch each half separately
+        if e.status_code == 400 and len(coordinates) > 1:
+            middle = len(coordinates) // 2
+            return open_meteo_lookup(coordinates[:middle]) + open_meteo_lookup(coordinates[middle:])
+        # The bad coordinate goes to the dead letter queue on its own
+        if e.status_code == 400:
+            return [e]
+        raise
+
+    # Parse the JSON response and extract the elevations (in the same order as the coordinates)
+    try:
+        open_meteo_data = response.json()
+        elevations = [
+            int(elevation) if elevation is not None else ""
+            for elevation in open_meteo_data["elevation"]
+        ]
+    except (ValueError, KeyError, TypeError) as e:
+        raise LookupFailed(f"Invalid response for coordinates {coordinates[0]}...{coordinates[-1]} ({len(coordinates)}): {e}")
+    if len(elevations) != len(coordinates):
+        raise LookupFailed(f"Expected {len(coordinates)} elevations, got {len(elevations)}")
 
-            if isinstance(e, HTTPError):
-                if e.response.status_code == 503:
-                    logging.error("Service unavailable. Retrying...")
+    with lookup_count_lock:
+        open_meteo_lookup_count += len(elevations)
 
-            # If it's the last attempt, re-raise the exception
-            if attempt == max_retries:
-                logging.error(f"Failed to retrieve geocode after {max_retries} attempts")
-                saveAndStop()
+    return elevations
 
 
 # Count duplicate items (country_code, name)
 def count_duplicate_items():
     count_items = {}
     for geonameid, value in combined_dataset.items():
-        key = (value["country_code"], value["name"])
+        key = (value.country_code, value.name)
         if key not in count_items:
             count_items[key] = 0
         count_items[key] += 1
@@ -871,11 +2351,11 @@ def create_state_geocode_list(state_geocode_list):
     # Append geonameid to list
     for geonameid, value in combined_dataset.items():
         if (
-            value["country_code"].lower() in country_list_for_states.lower().split(",")
+            value.country_code.lower() in country_list_for_states.lower().split(",")
             or country_list_for_states == ""
         ):
             if include_state_for_dupe == True:
-                key = (value["country_code"], value["name"])
+                key = (value.country_code, value.name)
                 if count_items[key] > 1:
                     state_geocode_list.append(geonameid)
             else:
@@ -891,12 +2371,12 @@ def create_county_geocode_list(county_geocode_list):
     # Append geonameid to list
     for geonameid, value in combined_dataset.items():
         if (
-            value["country_code"].lower()
+            value.country_code.lower()
             in country_list_for_counties.lower().split(",")
             or country_list_for_counties == ""
         ):
             if include_county_for_dupe == True:
-                key = (value["country_code"], value["name"])
+                key = (value.country_code, value.name)
                 if count_items[key] > 1:
                     county_geocode_list.append(geonameid)
             else:
@@ -905,84 +2385,129 @@ def create_county_geocode_list(county_geocode_list):
     return county_geocode_list
 
 
+# Build (geonameid, (lat, lng)) items for run_lookups
+def lookup_items(geonameids):
+    for geonameid in geonameids:
+        value = combined_dataset[geonameid]
+        yield geonameid, (value.latitude, value.longitude)
+
+
 # Combine State and County Data
 def combine_state_and_county_data(state_geocode_list, county_geocode_list):
-    state_and_county_list = list(set(state_geocode_list) | set(county_geocode_list))
+    state_and_county_list = set(state_geocode_list) | set(county_geocode_list)
     total_items_to_lookup = len(state_and_county_list)
 
     global geocodeLookupStarted
     geocodeLookupStarted = True
 
     print(f"> Fetching state and county data for {total_items_to_lookup} cities...\n")
+    start_stage("state_county")
 
     manager = enlighten.get_manager()
     progress_bar = manager.counter(
         total=total_items_to_lookup, desc="Fetching", unit="city"
     )
 
-    if not "found_resume_target" in locals():
-        found_resume_target = False
-
-    if not "current_geonameid" in globals():
-        global current_geonameid
-        current_geonameid = None
-
     if not "count_file" in globals():
         global count_file
         count_file = 0
+    count_admin_codes = 0
 
-    for geonameid, value in combined_dataset.items():
-        if (resume == True) and (not found_resume_target):
-            if geonameid != current_geonameid:
-                if geonameid in state_and_county_list:
-                    progress_bar.update()
-                continue
-            found_resume_target = True
-            print(f"> Skipped to: {geonameid}")
+    state_list = set(state_geocode_list)
+    county_list = set(county_geocode_list)
 
-        current_geonameid = geonameid
-        if geonameid in state_and_county_list:
-            key = (
-                combined_dataset[geonameid]["latitude"],
-                combined_dataset[geonameid]["longitude"],
-            )
+    start_journal()
+
+    geocode_queue = []
+    geo_fcc_queue = []
 
-            def get_state_and_county_from_geocode():
-                [state, county] = geocode_lookup(value["latitude"], value["longitude"])
-                print(f"> Fetched state and county from geocode: {key} - {state if state else 'unknown'} - {county if county else 'unknown'}")
-                combined_dataset[geonameid]["state"] = state
-                combined_dataset[geonameid]["county"] = county
+    # Secondary county name fetcher for US locations
+    def needs_geo_fcc_lookup(geonameid):
+        return (combined_dataset[geonameid].country_code == "US" and combined_dataset[geonameid].county == "")
+
+    # Fill from the admin codes or reference dataset and queue everything else for geocode
+    for geonameid, value in combined_dataset.items():
+        if geonameid in state_and_county_list:
+            # Use the admin code names if they cover everything this city needs (missing US counties come from geo.fcc.gov)
+            if useAdminCodes == True:
+                state, county = get_admin_names(value)
+                if (state or geonameid not in state_list) and (county or geonameid not in county_list or value.country_code == "US"):
+                    count_admin_codes += 1
+                    combined_dataset[geonameid].state = state
+                    combined_dataset[geonameid].county = county
+
+                    if needs_geo_fcc_lookup(geonameid):
+                        geo_fcc_queue.append(geonameid)
+                    else:
+                        progress_bar.update()
+                    continue
 
-            if reference_dataset.get(key):
+            reference = find_reference(value)
+            if reference:
                 # Force refetch of empty values
-                # state = reference_dataset.get(key, {}).get("state")
-                # county = reference_dataset.get(key, {}).get("county")
+                # state = reference.get("state")
+                # county = reference.get("county")
                 # if not state and not county:
                 # get_state_and_county_from_geocode()
                 # else:
-                state = reference_dataset.get(key, {}).get("state")
-                county = reference_dataset.get(key, {}).get("county")
+                state = reference.get("state")
+                county = reference.get("county")
                 if state != "" or county != "": 
                     count_file += 1
-                combined_dataset[geonameid]["state"] = state
-                combined_dataset[geonameid]["county"] = county
+                combined_dataset[geonameid].state = state
+                combined_dataset[geonameid].county = county
+
+                if needs_geo_fcc_lookup(geonameid):
+                    geo_fcc_queue.append(geonameid)
+                else:
+                    progress_bar.update()
             else:
-                get_state_and_county_from_geocode()
-            
-            # Secondary county name fetcher for US locations
-            if (combined_dataset[geonameid]["country_code"] == "US" and combined_dataset[geonameid]["county"] == ""):
-                county = geo_fcc_lookup(value["latitude"], value["longitude"])
-                print(f"> Fetched county from geo.fcc.gov: {key} - {county if county else 'unknown'}")
-                combined_dataset[geonameid]["county"] = county
-            
+                geocode_queue.append(geonameid)
+
+    # Fetch state and county from geocode (the api key is checked first so any prompt happens on the main thread)
+    if geocode_queue:
+        checkGeocodeKey()
+    for geonameid, [state, county] in run_lookups("geocode", geocode_lookup, lookup_items(geocode_queue)):
+        key = (
+            combined_dataset[geonameid].latitude,
+            combined_dataset[geonameid].longitude,
+        )
+        print(f"> Fetched state and county from geocode: {key} - {state if state else 'unknown'} - {county if county else 'unknown'}")
+        combined_dataset[geonameid].state = state
+        combined_dataset[geonameid].county = county
+
+        if needs_geo_fcc_lookup(geonameid):
+            geo_fcc_queue.append(geonameid)
+        else:
             progress_bar.update()
+
+    # Fetch missing US counties from geo.fcc.gov
+    for geonameid, county in run_lookups("geo_fcc", geo_fcc_lookup, lookup_items(geo_fcc_queue)):
+        key = (
+            combined_dataset[geonameid].latitude,
+            combined_dataset[geonameid].longitude,
+        )
+        print(f"> Fetched county from geo.fcc.gov: {key} - {county if county else 'unknown'}")
+        combined_dataset[geonameid].county = county
+        progress_bar.update()
+
     progress_bar.close()
     manager.stop()
+    found_items = sum(1 for geonameid in state_and_county_list if combined_dataset[geonameid].state or combined_dataset[geonameid].county)
+    stop_stage("state_county", total_items_to_lookup, found_items)
 
-    print("\nFetched From File: ", count_file)
+    print("\nFetched From Admin Codes: ", count_admin_codes)
+    print("Fetched From File: ", count_file)
     print("Fetched From Geocode: ", geocode_lookup_count)
     print("Fetched From Geo FCC: ", geo_fcc_lookup_count)
-    print("Total: ", count_file + geocode_lookup_count + geo_fcc_lookup_count)
+    print("Total: ", count_admin_codes + count_file + geocode_lookup_count + geo_fcc_lookup_count)
+    print_cache_stats("geocode")
+    print_cache_stats("geo_fcc")
+    print_coalesce_stats("geocode")
+    print_coalesce_stats("geo_fcc")
+    print_dead_letter_stats("geocode")
+    print_dead_letter_stats("geo_fcc")
+    print_reference_match_report()
 
 
 # Combine Elevation Data
@@ -990,46 +2515,56 @@ def combine_elevation_data():
     total_items_to_lookup = 0
     ref_file_lookup_count = 0
     for item in combined_dataset.values():
-        if item.get("elevation") == "":
+        if item.elevation == "":
             total_items_to_lookup += 1
 
     print(f"\n> Fetching missing elevation data for {total_items_to_lookup} cities...\n")
+    start_stage("elevation")
+    found_items = 0
 
     manager = enlighten.get_manager()
     progress_bar = manager.counter(
         total=total_items_to_lookup, desc="Fetching", unit="city"
     )
 
-    for geonameid, value in combined_dataset.items():
+    global geocodeLookupStarted
+    geocodeLookupStarted = True
+    start_journal()
 
-        key = (
-            combined_dataset[geonameid]["latitude"],
-            combined_dataset[geonameid]["longitude"],
-        )
+    open_meteo_queue = []
 
-        def get_elevation_from_open_meteo():
-            elevation = open_meteo_lookup(value["latitude"], value["longitude"])
-            print(f"> Fetched elevation from open meteo: {value["latitude"],value["longitude"]} - {elevation if elevation else 'unknown'}")
-            combined_dataset[geonameid]["elevation"] = elevation
-        
-        if (not combined_dataset[geonameid]["elevation"]):
-            if reference_dataset.get(key):
-                elevation = reference_dataset.get(key, {}).get("elevation")
-                if elevation: 
-                    ref_file_lookup_count += 1
-                    combined_dataset[geonameid]["elevation"] = elevation
-                else:
-                    get_elevation_from_open_meteo()
+    for geonameid, value in combined_dataset.items():
+        if (not combined_dataset[geonameid].elevation):
+            elevation = (find_reference(value) or {}).get("elevation")
+            if elevation:
+                ref_file_lookup_count += 1
+                found_items += 1
+                combined_dataset[geonameid].elevation = elevation
+                progress_bar.update()
             else:
-                get_elevation_from_open_meteo()
-
+                open_meteo_queue.append(geonameid)
+
+    # Fetch elevation from open meteo
+    batch_size = min(max(1, provider_limits["open_meteo"]["batch_size"]), open_meteo_max_batch_size)
+    for geonameid, elevation in run_lookups("open_meteo", open_meteo_lookup, lookup_items(open_meteo_queue), batch_size):
+        value = combined_dataset[geonameid]
+        print(f"> Fetched elevation from open meteo: {(value.latitude, value.longitude)} - {elevation if elevation else 'unknown'}")
+        combined_dataset[geonameid].elevation = elevation
+        if elevation != "":
+            found_items += 1
         progress_bar.update()
+
     progress_bar.close()
     manager.stop()
+    stop_stage("elevation", total_items_to_lookup, found_items)
 
     print("\nFetched From File: ", ref_file_lookup_count)
     print("Fetched From Open Meteo: ", open_meteo_lookup_count)
     print("Total: ", ref_file_lookup_count + open_meteo_lookup_count)
+    print_cache_stats("open_meteo")
+    print_coalesce_stats("open_meteo")
+    print_dead_letter_stats("open_meteo")
+    print_reference_match_report()
 
 
 # ===== Process Datasets and Generate Custom Dataset =====
@@ -1037,8 +2572,14 @@ def combine_elevation_data():
 
 # Prompt user, download and combine datasets, and create custom dataset
 def process_datasets(population_threshold):
-    # Prompt and set variables for which attributes to include in the custom dataset
-    set_include_attributes()
+    global selected_population_threshold
+    selected_population_threshold = population_threshold
+
+    # Prompt and set variables for which attributes to include in the custom dataset (restored from the resume file when resuming)
+    if resume == True:
+        create_reference_dataset()
+    else:
+        set_include_attributes()
 
     # Get start time
     global start_time
@@ -1059,7 +2600,7 @@ def process_datasets(population_threshold):
     combine_cities_dataset()
 
     # Add alternative place names dataset to combined_dataset
-    if include_altnames == True:
+    if include_altnames == True or (autocomplete and autocompleteLanguages):
         download_alt_names_dataset()
         combine_altname_dataset(alternative_names_dataset)
 
@@ -1092,210 +2633,456 @@ def process_datasets(population_threshold):
     return process_datasets_2()
 
 
-# Split so the resume function can start from here
+# Combine lookup data and generate the custom dataset
 def process_datasets_2():
     # Combine State and County Data
     if include_state == True or include_county == True:
+        if useAdminCodes == True:
+            download_admin_codes_datasets()
         combine_state_and_county_data(state_geocode_list, county_geocode_list)
 
     # Combine Elevation Data
     if include_elevation == True:
         combine_elevation_data()
 
-    # Generate custom dataset with requested information
-    custom_dataset_json = generate_custom_dataset(combined_dataset)
+    # Generate custom dataset with requested information (items are generated as the output file is written)
+    return generate_custom_dataset(combined_dataset)
 
-    if resume == False:
-        # Get end time
-        end_time = time.time()
 
-        # Time elapsed
-        elapsed_time = round(end_time - start_time, 2)
+# Print and log the elapsed time
+def print_elapsed_time():
+    # Get end time
+    end_time = time.time()
 
-        def convert_seconds_with_milliseconds(elapsed_time):
-            hours = int(elapsed_time // 3600)
-            remaining_seconds = elapsed_time % 3600
-            minutes = int(remaining_seconds // 60)
-            remaining_seconds %= 60
-            seconds = int(remaining_seconds)
-            milliseconds = (remaining_seconds - seconds) * 1000
-            return hours, minutes, seconds, milliseconds
+    # Time elapsed
+    elapsed_time = round(end_time - start_time, 2)
 
-        hours, minutes, seconds, milliseconds = convert_seconds_with_milliseconds(
-            elapsed_time
-        )
-        print(f"> Elapsed time: {hours} hours, {minutes} minutes, {seconds} seconds, and {milliseconds:.2f} milliseconds.")
+    def convert_seconds_with_milliseconds(elapsed_time):
+        hours = int(elapsed_time // 3600)
+        remaining_seconds = elapsed_time % 3600
+        minutes = int(remaining_seconds // 60)
+        remaining_seconds %= 60
+        seconds = int(remaining_seconds)
+        milliseconds = (remaining_seconds - seconds) * 1000
+        return hours, minutes, seconds, milliseconds
 
-        # Log
-        logging.info(f"Time finished: {end_time}")
-        logging.info(f"Elapsed time: {elapsed_time}")
+    hours, minutes, seconds, milliseconds = convert_seconds_with_milliseconds(
+        elapsed_time
+    )
+    print(f"> Elapsed time: {hours} hours, {minutes} minutes, {seconds} seconds, and {milliseconds:.2f} milliseconds.")
 
-    logging.info(f"Processed {total_items_in_cities_dataset} items")
+    # Log
+    logging.info(f"Time finished: {end_time}")
+    logging.info(f"Elapsed time: {elapsed_time}")
 
-    return custom_dataset_json
+    logging.info(f"Processed {total_items_in_cities_dataset} items")
 
 
 # ===== Save and Resume =====
 
-resume_filename = "resume_data.dat"
+# Resume settings are saved when lookups start, and every completed lookup is appended to the journal
+resume_filename = "resume_data.json"
+journal_filename = "resume_journal.jsonl"
+journal_file = None
+resume_journal = {}
+
+
+# Save the settings needed to rebuild the combined dataset on resume
+def save_resume_settings():
+    resume_data = {
+        "population_threshold": selected_population_threshold,
+        "filetype": filetype,
+        "filename": filename,
+        "include_country_code": include_country_code,
+        "include_country_name": include_country_name,
+        "include_altnames": include_altnames,
+        "include_geonameid": include_geonameid,
+        "include_state": include_state,
+        "include_county": include_county,
+        "include_state_for_dupe": include_state_for_dupe,
+        "include_county_for_dupe": include_county_for_dupe,
+        "include_timezone": include_timezone,
+        "include_population": include_population,
+        "include_elevation": include_elevation,
+        "include_continent": include_continent,
+        "include_capital": include_capital,
+        "include_currency_code": include_currency_code,
+        "include_currency_name": include_currency_name,
+        "include_phone": include_phone,
+        "include_languages": include_languages,
+        "include_country_neighbours": include_country_neighbours,
+        "abbreviate_us_states": abbreviate_us_states,
+        "useAdminCodes": useAdminCodes,
+        "country_list_for_states": country_list_for_states,
+        "country_list_for_counties": country_list_for_counties,
+        "geocode_lookup_count": geocode_lookup_count,
+        "geo_fcc_lookup_count": geo_fcc_lookup_count,
+        "open_meteo_lookup_count": open_meteo_lookup_count,
+        "matrix": matrix,
+        "matrix_thresholds": matrix_thresholds,
+        "matrix_presets": matrix_presets,
+        "matrix_formats": matrix_formats,
+    }
+    with open(resume_filename, "w", encoding="utf-8") as file:
+        json.dump(resume_data, file, indent=2)
+
+
+# Open the journal for appending, starting a new one unless resuming
+def start_journal():
+    global journal_file
+    if journal_file is None:
+        save_resume_settings()
+        journal_file = open(journal_filename, "a" if resume == True else "w", encoding="utf-8")
+
+
+# Append a completed lookup to the journal
+def write_journal(provider, geonameid, result):
+    if journal_file is not None:
+        journal_file.write(json.dumps([provider, geonameid, result], ensure_ascii=False) + "\n")
+        journal_file.flush()
+
+
+# Remove the resume files after the output has been saved
+def clear_resume_files():
+    global journal_file
+    if journal_file is not None:
+        journal_file.close()
+        journal_file = None
+    for file in [resume_filename, journal_filename, dead_letter_filename]:
+        if os.path.exists(file):
+            os.remove(file)
 
 
 # Save and Stop
 def saveAndStop():
-    print(f"\n> Stopped at geocodeid: {current_geonameid}")
-    start_spinner(f"Saving resume data to {resume_filename}")
-    resume_data = [
-        {
-            "current_geonameid": current_geonameid,
-            "filetype": filetype,
-            "filename": filename,
-            "include_country_code": include_country_code,
-            "include_country_name": include_country_name,
-            "include_altnames": include_altnames,
-            "include_geonameid": include_geonameid,
-            "include_state": include_state,
-            "include_county": include_county,
-            "include_state_for_dupe": include_state_for_dupe,
-            "include_county_for_dupe": include_county_for_dupe,
-            "include_timezone": include_timezone,
-            "include_population": include_population,
-            "include_elevation": include_elevation,
-            "include_continent": include_continent,
-            "include_capital": include_capital,
-            "include_currency_code": include_currency_code,
-            "include_currency_name": include_currency_name,
-            "include_phone": include_phone,
-            "include_languages": include_languages,
-            "include_country_neighbours": include_country_neighbours,
-            "abbreviate_us_states": abbreviate_us_states,
-            "country_list_for_states": country_list_for_states,
-            "country_list_for_counties": country_list_for_counties,
-            "county_geocode_list": county_geocode_list,
-            "state_geocode_list": state_geocode_list,
-            "total_items_in_cities_dataset": total_items_in_cities_dataset,
-            "geocode_lookup_count": geocode_lookup_count,
-            "count_file": count_file,
-            "reference_dataset": reference_dataset,
-            "combined_dataset": combined_dataset,
-        }
-    ]
+    # Lookups running on worker threads hand the stop back to the main thread
+    if threading.current_thread() is not threading.main_thread():
+        raise StopLookups()
 
-    with open(resume_filename, "wb") as handle:
-        pickle.dump(resume_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        stop_spinner("done\n")
-        sys.exit(0)
+    stop_lookups()
+    print(f"\n> Stopped. Completed lookups are saved in {journal_filename}")
+    start_spinner(f"Saving resume data to {resume_filename}")
+    save_resume_settings()
+    if journal_file is not None:
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    stop_spinner("done\n")
+    write_metrics()
+    sys.exit(0)
 
 
 # Resume
 def resumeFromSave():
     start_spinner(f"Loading resume file {resume_filename}")
-    resume_data = []
-    with open(resume_filename, "rb") as file:
-        try:
-            while True:
-                resume_data.extend(pickle.load(file))
-                # print(resume_data)
-                variables = {key: value for key, value in resume_data[0].items()}
-                for key, value in variables.items():
-                    globals()[key] = value
-                # for key, value in resume_data[0].items():
-                # print(key, value)
-                stop_spinner("done\n")
-                print(f"> Resuming from geocodeid: {current_geonameid}\n")
-                # sys.exit(0)
-        except EOFError:
-            pass
+    with open(resume_filename, "r", encoding="utf-8") as file:
+        resume_data = json.load(file)
+    for key, value in resume_data.items():
+        globals()[key] = value
+    load_resume_journal()
+    stop_spinner("done\n")
+    print(f"> Resuming with {len(resume_journal)} completed lookups\n")
+    return resume_data["population_threshold"]
+
+
+# Load completed lookups from the journal
+def load_resume_journal():
+    if os.path.exists(journal_filename):
+        with open(journal_filename, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    provider, geonameid, result = json.loads(line)
+                except ValueError:
+                    # A hard kill can leave the last line incomplete
+                    continue
+                resume_journal[(provider, geonameid)] = result
 
 
 # ===== Generate Custom Dataset =====
 
 
+# Number of items created at a time by generate_custom_dataset
+projection_block_size = 1000
+
+
+# Generate the custom dataset one item at a time so it can be written as it is generated
 def generate_custom_dataset(combined_dataset):
-    print("\n> Generating custom dataset...")
-    custom_dataset_json = []
     manager = enlighten.get_manager()
     progress_bar = manager.counter(total=len(combined_dataset), desc="Generating", unit="item")
 
-    for geonameid, value in combined_dataset.items():
+    state_geonameids = set(state_geocode_list)
+    county_geonameids = set(county_geocode_list)
 
-        # Create JSON object for current line/place
-        item = {
-            "name": value["name"],
-            "lat": value["latitude"],
-            "lng": value["longitude"],
-        }
+    # Time spent creating the items (recorded as the projection stage, separate from the time spent writing them)
+    projection_wall = 0.0
+    projection_cpu = 0.0
+    item_count = 0
 
-        # Include Geonameid
-        if include_geonameid == True:
-            item["geonameid"] = value["geonameid"]
+    # Items are created in blocks, so the projection is timed once per block rather than once per item
+    places = iter(combined_dataset.items())
+    while True:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        items = []
+        for geonameid, value in itertools.islice(places, projection_block_size):
+            # Create JSON object for current line/place
+            item = {
+                "name": value.name,
+                "lat": value.latitude,
+                "lng": value.longitude,
+            }
+
+            # Include Geonameid
+            if include_geonameid == True:
+                item["geonameid"] = value.geonameid
+
+            # Include Alternative Names
+            if include_altnames == True:
+                item["altnames"] = value.alternatenames
+
+            # Include Timezone?
+            if include_timezone == True:
+                item["timezone"] = value.timezone
+
+            # Include Population?
+            if include_population == True:
+                item["population"] = value.population
+
+            # Include Elevation?
+            if include_elevation == True:
+                item["elevation"] = value.elevation
+
+            # Include Country Code?
+            if include_country_code == True:
+                item["country"] = value.country_code
+
+            # Include Country Names?
+            if include_country_name == True:
+                item["country_name"] = value.country.get("country_name", "")
+
+            # Include State
+            if include_state == True:
+                if geonameid in state_geonameids:
+                    item["state"] = value.state
+
+            # Include County
+            if include_county == True:
+                if geonameid in county_geonameids:
+                    item["county"] = value.county if value.county else ""
+
+            # Include Country Capital?
+            if include_capital == True:
+                item["capital"] = value.country.get("capital", "")
+
+            # Include Continent?
+            if include_continent == True:
+                item["continent"] = value.country.get("continent", "")
+
+            # Include Currency Code?
+            if include_currency_code == True:
+                item["currency_code"] = value.country.get("currency_code", "")
+
+            # Include Currency Name?
+            if include_currency_name == True:
+                item["currency_name"] = value.country.get("currency_name", "")
+
+            # Include Phone?
+            if include_phone == True:
+                item["phone"] = value.country.get("phone", "")
+
+            # Include Languages?
+            if include_languages == True:
+                item["languages"] = value.country.get("languages", "")
+
+            # Include Neighbours?
+            if include_country_neighbours == True:
+                item["neighbours"] = value.country.get("neighbours", "")
+
+            items.append(item)
+        projection_wall += time.perf_counter() - wall_start
+        projection_cpu += time.process_time() - cpu_start
+        if not items:
+            break
+        item_count += len(items)
+        for item in items:
+            yield item
+            progress_bar.update()
+    progress_bar.close()
+    manager.stop()
+    record_nested_stage("projection", projection_wall, projection_cpu, len(combined_dataset), item_count)
+
+
+# ===== Output Writers =====
+
+
+# Get the output columns, in CSV header order, for the selected options
+def get_output_keys():
+    selected_keys = {
+        "continent": include_continent,
+        "country": include_country_code,
+        "country_name": include_country_name,
+        "state": include_state,
+        "county": include_county,
+        "geonameid": include_geonameid,
+        "name": True,
+        "altnames": include_altnames,
+        "lat": True,
+        "lng": True,
+        "timezone": include_timezone,
+        "population": include_population,
+        "elevation": include_elevation,
+        "capital": include_capital,
+        "currency_code": include_currency_code,
+        "currency_name": include_currency_name,
+        "phone": include_phone,
+        "languages": include_languages,
+        "neighbours": include_country_neighbours,
+    }
+    return [key for key in get_custom_csv_header_order() if selected_keys[key]]
+
+
+# Write items as a JSON array, one item at a time
+def write_json(items, outfile, compact=False):
+    outfile.write("[")
+    first = True
+    for item in items:
+        if compact:
+            outfile.write(("" if first else ",") + json.dumps(item, ensure_ascii=False, separators=(",", ":")))
+        else:
+            # Match the layout of json.dump(..., indent=2) for the whole list
+            text = json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+            outfile.write(("\n  " if first else ",\n  ") + text)
+        first = False
+    outfile.write("]" if first or compact else "\n]")
 
-        # Include Alternative Names
-        if include_altnames == True:
-            item["altnames"] = value["alternatenames"]
 
-        # Include Timezone?
-        if include_timezone == True:
-            item["timezone"] = value["timezone"]
+# Write items as newline delimited JSON
+def write_ndjson(items, outfile):
+    for item in items:
+        outfile.write(json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n")
 
-        # Include Population?
-        if include_population == True:
-            item["population"] = value["population"]
 
-        # Include Elevation?
-        if include_elevation == True:
-            item["elevation"] = value["elevation"]
+# Write items as CSV rows with the given header
+def write_csv(items, outfile, keys):
+    csv_writer = csv.writer(outfile)
+    csv_writer.writerow(keys)
+    for item in items:
+        csv_writer.writerow([item.get(key, "") for key in keys])
 
-        # Include Country Code?
-        if include_country_code == True:
-            item["country"] = value["country_code"]
 
-        # Include Country Names?
-        if include_country_name == True:
-            item["country_name"] = value["country_name"]
+# ===== Matrix Build =====
 
-        # Include State
-        if include_state == True:
-            if geonameid in state_geocode_list:
-                item["state"] = value["state"]
+# Feature codes GeoNames includes in a cities file regardless of population (the 500 file includes every place)
+threshold_feature_codes = {
+    1000: {"PPLC", "PPLA", "PPLA2", "PPLA3"},
+    5000: {"PPLC", "PPLA"},
+    15000: {"PPLC"},
+}
 
-        # Include County
-        if include_county == True:
-            if geonameid in county_geocode_list:
-                item["county"] = value["county"] if value["county"] else ""
 
-        # Include Country Capital?
-        if include_capital == True:
-            item["capital"] = value["capital"]
+# Get the cities in the combined dataset that belong to the cities file for a population threshold
+def filter_population_threshold(dataset, population_threshold, parsed_threshold):
+    if population_threshold <= parsed_threshold:
+        return dataset
+    feature_codes = threshold_feature_codes[population_threshold]
+    return {
+        geonameid: value
+        for geonameid, value in dataset.items()
+        if (value.population or 0) > population_threshold or value.feature_code in feature_codes
+    }
+
+
+# Select the cities and preset for one output of the matrix
+def select_matrix_output(dataset, preset):
+    global combined_dataset
+    global state_geocode_list
+    global county_geocode_list
+
+    combined_dataset = dataset
+    reset_include_attributes()
+    apply_preset(preset)
+    state_geocode_list = create_state_geocode_list([]) if include_state == True else []
+    county_geocode_list = create_county_geocode_list([]) if include_county == True else []
 
-        # Include Continent?
-        if include_continent == True:
-            item["continent"] = value["continent"]
 
-        # Include Currency Code?
-        if include_currency_code == True:
-            item["currency_code"] = value["currency_code"]
+# Build every threshold x preset x format output from a single parse of the lowest threshold
+def build_matrix(thresholds, presets, formats):
+    global combined_dataset
+    global start_time
+    global filetype
+    global filename
+    global selected_population_threshold
 
-        # Include Currency Name?
-        if include_currency_name == True:
-            item["currency_name"] = value["currency_name"]
+    if not thresholds or not presets or not formats:
+        print("! --matrix needs at least one valid threshold, preset, and format.")
+        return
 
-        # Include Phone?
-        if include_phone == True:
-            item["phone"] = value["phone"]
+    start_time = time.time()
+    parsed_threshold = min(thresholds)
+    selected_population_threshold = parsed_threshold
+    filetype = formats[0]
+    filename = "matrix"
 
-        # Include Languages?
-        if include_languages == True:
-            item["languages"] = value["languages"]
+    print(f"> Matrix build. Thresholds: {thresholds}, presets: {presets}, formats: {formats}")
+    logging.info(f"Matrix build. Thresholds: {thresholds}, presets: {presets}, formats: {formats}")
 
-        # Include Neighbours?
-        if include_country_neighbours == True:
-            item["neighbours"] = value["neighbours"]
+    if resume == True:
+        load_resume_journal()
 
-        custom_dataset_json.append(item)
-        progress_bar.update()
-    progress_bar.close()
-    manager.stop()
-    return custom_dataset_json
+    reset_include_attributes()
+    create_reference_dataset()
+
+    # Parse the lowest threshold once (its cities file contains the cities of every higher threshold)
+    combined_dataset = {}
+    download_cities_dataset(parsed_threshold)
+    combine_cities_dataset()
+    if autocomplete and autocompleteLanguages:
+        download_alt_names_dataset()
+        combine_altname_dataset(alternative_names_dataset)
+    full_dataset = combined_dataset
+    datasets = {
+        population_threshold: filter_population_threshold(full_dataset, population_threshold, parsed_threshold)
+        for population_threshold in thresholds
+    }
+
+    # Collect the lookups needed by every output so each place is only looked up once
+    state_geonameids = set()
+    county_geonameids = set()
+    elevation_dataset = {}
+    for population_threshold in thresholds:
+        for preset in presets:
+            select_matrix_output(datasets[population_threshold], preset)
+            state_geonameids.update(state_geocode_list)
+            county_geonameids.update(county_geocode_list)
+            if include_elevation == True:
+                elevation_dataset.update(datasets[population_threshold])
+
+    combined_dataset = full_dataset
+    if state_geonameids or county_geonameids:
+        if useAdminCodes == True:
+            download_admin_codes_datasets()
+        combine_state_and_county_data(list(state_geonameids), list(county_geonameids))
+
+    if elevation_dataset:
+        combined_dataset = elevation_dataset
+        combine_elevation_data()
+
+    # Write every output from the shared dataset
+    saved = True
+    for population_threshold in thresholds:
+        # The autocomplete index only depends on the cities, so one is saved per threshold (named as the preset 1 file)
+        if autocomplete:
+            save_autocomplete_index(build_autocomplete_index(datasets[population_threshold]), get_preset_filename(1, population_threshold))
+        for preset in presets:
+            select_matrix_output(datasets[population_threshold], preset)
+            for output_filetype in formats:
+                custom_dataset = generate_custom_dataset(combined_dataset)
+                if not save_custom_dataset(custom_dataset, get_preset_filename(preset, population_threshold), output_filetype):
+                    saved = False
+
+    if saved and not report_dead_letters():
+        clear_resume_files()
+    print_elapsed_time()
+    write_metrics()
 
 
 # ===== CLI Prompts =====
@@ -1353,15 +3140,106 @@ def get_format(prompt):
         response = input(prompt).strip().lower()
         if response == "json":
             return "json"
+        elif response == "ndjson":
+            return "ndjson"
         elif response == "csv":
             return "csv"
         else:
-            print("> Please enter 'json' or 'csv'.")
+            print("> Please enter 'json', 'ndjson' or 'csv'.")
+
+
+reference_dataset = None
+reference_match_counts = {"exact": 0, "approximate": 0, "missed": 0}
+
+
+# Distance in metres between two coordinates
+def haversine_distance(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+# Find the reference row for a city by exact coordinates or geonameid, or fall back to the nearest row within the tolerance
+def find_reference(city):
+    if reference_dataset is None:
+        reference_match_counts["missed"] += 1
+        return None
+
+    item = reference_dataset.get((city.latitude, city.longitude))
+    if item is None:
+        item = reference_dataset.get_by_geonameid(int(city.geonameid))
+    if item is not None:
+        reference_match_counts["exact"] += 1
+        return item
+
+    if args.reference_tolerance <= 0:
+        reference_match_counts["missed"] += 1
+        return None
+
+    # Scan the rows in the latitude band (1 degree of latitude is about 111320 metres), skipping rows too far east or west
+    lat_range = args.reference_tolerance / 111320
+    lng_range = lat_range / max(math.cos(math.radians(city.latitude)), 0.01)
+    nearest = None
+    nearest_distance = args.reference_tolerance
+    for i in reference_dataset.rows_between(city.latitude - lat_range, city.latitude + lat_range):
+        lat = reference_dataset.lats[i]
+        lng = reference_dataset.lngs[i]
+        # Longitudes wrap around at the dateline
+        lng_difference = abs(lng - city.longitude)
+        if min(lng_difference, 360 - lng_difference) > lng_range:
+            continue
+        distance = haversine_distance(city.latitude, city.longitude, lat, lng)
+        if distance > nearest_distance:
+            continue
+        item = reference_dataset.allowed_row(i)
+        if item is None:
+            continue
+        if args.reference_match_name and item["name"] != city.name and item.get("geonameid") != str(city.geonameid):
+            continue
+        nearest = item
+        nearest_distance = distance
 
+    reference_match_counts["approximate" if nearest is not None else "missed"] += 1
+    return nearest
 
-# Prompt and set variables for which attributes to include in the custom dataset
-def set_include_attributes():
-    # Init vars
+
+# Print and log how many cities were matched to the reference dataset, then reset the counts for the next stage
+def print_reference_match_report():
+    if disableReference == True:
+        return
+    report = f"Reference matches: {reference_match_counts['exact']} exact, {reference_match_counts['approximate']} approximate (within {args.reference_tolerance:g}m), {reference_match_counts['missed']} not found"
+    print(report)
+    logging.info(report)
+    for key in reference_match_counts:
+        reference_match_counts[key] = 0
+
+
+# Select the reference snapshot and the countries to match against
+def create_reference_dataset(country_list_for_states="", country_list_for_counties=""):
+    global reference_dataset
+    reference_dataset = None
+
+    if disableReference == False:
+        print("> Using prefetched reference dataset to optimise fetching State, County, and Elevation data.")
+        if not ref_data:
+            download_reference_file()
+        combined_country_list = list(
+            filter(
+                bool,
+                set(country_list_for_states.lower().split(","))
+                | set(country_list_for_counties.lower().split(",")),
+            )
+        )
+        print(f"> Creating reference dataset with countries: {combined_country_list if combined_country_list else '(all)'}")
+        if ref_data:
+            ref_data.countries = set(combined_country_list) if combined_country_list else None
+            reference_dataset = ref_data
+    else:
+        print("> Reference dataset will NOT be used. Fetching State and County data will take a long time.")
+
+
+# Reset the variables for which attributes to include in the custom dataset
+def reset_include_attributes():
     global include_country_code
     include_country_code = False
     global include_country_name
@@ -1404,68 +3282,29 @@ def set_include_attributes():
     country_list_for_states = ""
     global country_list_for_counties
     country_list_for_counties = ""
-    global reference_dataset
-    reference_dataset = {}
 
-    # Reference Dataset
-    if disableReference == False:
-        print("> Using prefetched reference dataset to optimise fetching State, County, and Elevation data.")
-        if not ref_data:
-            download_reference_file()
-        combined_country_list = list(
-            filter(
-                bool,
-                set(country_list_for_states.lower().split(","))
-                | set(country_list_for_counties.lower().split(",")),
-            )
-        )
-        start_spinner(f"Creating reference dataset with countries: {combined_country_list if combined_country_list else '(all)'}")
-        # Append only required countries to lookup table
-        for item in ref_data:
-            if (
-                item["country"].lower() in combined_country_list
-                or combined_country_list == []
-            ):
-                lat = float(item["lat"])
-                lng = float(item["lng"])
-                name = item["name"]
-                reference_dataset[(lat, lng)] = item
-        stop_spinner("done")
-    else:
-        print("> Reference dataset will NOT be used. Fetching State and County data will take a long time.")
 
-    # If preset argument is used, set preset defaults, otherwise, prompt user for which data to include
+# Set the include variables for a preset
+def apply_preset(preset):
+    global include_country_code
+    global include_state
+    global include_county
+    global include_state_for_dupe
+    global include_county_for_dupe
+    global include_elevation
+    global country_list_for_states
+    global abbreviate_us_states
+
     if preset == 0:
         include_country_code = True
         include_state = True
-        ref_data_states = {}
-        if ref_data:
-            for item in ref_data:
-                lat = float(item["lat"])
-                lng = float(item["lng"])
-                name = item["name"]
-                ref_data_states[(lat, lng, name)] = item
         include_county = True
-        ref_data_counties = {}
-        if ref_data:
-            for item in ref_data:
-                lat = float(item["lat"])
-                lng = float(item["lng"])
-                name = item["name"]
-                ref_data_counties[(lat, lng, name)] = item
     elif preset == 1:
         include_country_code = True
     elif preset == 2:
         include_country_code = True
         include_state = True
         country_list_for_states = "us"
-        ref_data_states = {}
-        for item in ref_data:
-            if item["country"].lower() in "us":
-                lat = float(item["lat"])
-                lng = float(item["lng"])
-                name = item["name"]
-                ref_data_states[(lat, lng, name)] = item
         abbreviate_us_states = True
     elif preset == 3:
         include_country_code = True
@@ -1476,22 +3315,42 @@ def set_include_attributes():
     elif preset == 4:
         include_country_code = True
         include_state = True
-        ref_data_states = {}
-        if ref_data:
-            for item in ref_data:
-                lat = float(item["lat"])
-                lng = float(item["lng"])
-                name = item["name"]
-                ref_data_states[(lat, lng, name)] = item
         include_county = True
-        ref_data_counties = {}
-        if ref_data:
-            for item in ref_data:
-                lat = float(item["lat"])
-                lng = float(item["lng"])
-                name = item["name"]
-                ref_data_counties[(lat, lng, name)] = item
         include_elevation = True
+
+
+# Prompt and set variables for which attributes to include in the custom dataset
+def set_include_attributes():
+    # Init vars
+    global include_country_code
+    global include_country_name
+    global include_altnames
+    global include_geonameid
+    global include_state
+    global include_county
+    global include_state_for_dupe
+    global include_county_for_dupe
+    global include_timezone
+    global include_population
+    global include_elevation
+    global include_continent
+    global include_capital
+    global include_currency_code
+    global include_currency_name
+    global include_phone
+    global include_languages
+    global include_country_neighbours
+    global abbreviate_us_states
+    global country_list_for_states
+    global country_list_for_counties
+    reset_include_attributes()
+
+    # Reference Dataset
+    create_reference_dataset(country_list_for_states, country_list_for_counties)
+
+    # If preset argument is used, set preset defaults, otherwise, prompt user for which data to include
+    if preset is not None:
+        apply_preset(preset)
     else:
         # Include country codes?
         if get_yes_or_no("? Include ISO-3166 2-letter country codes ('GB'): "):
@@ -1634,55 +3493,141 @@ def title():
     )
 
 
+# Get the output filename for a preset
+def get_preset_filename(preset, threshold):
+    if preset == 1:
+        if threshold == 1000:
+            return "world_cities"
+        return f"world_cities_{threshold}"
+    elif preset == 2:
+        if threshold == 1000:
+            return "world_cities_(including_US_states)"
+        return f"world_cities_{threshold}_(including_US_states)"
+    elif preset == 3:
+        if threshold == 1000:
+            return "world_cities_(including_states_and_counties_for_duplicate_names)"
+        return f"world_cities_{threshold}_(including_states_and_counties_for_duplicate_names)"
+    elif preset == 0:
+        if threshold == 1000:
+            return "world_cities_(including_all_states_and_counties)"
+        return f"world_cities_{threshold}_(including_all_states_and_counties)"
+    elif preset == 4:
+        if threshold == 1000:
+            return "world_cities_(including_all_states_counties_elevations)"
+        return f"world_cities_{threshold}_(including_all_states_and_counties_elevations)"
+
+
+# Save the custom dataset to filename.filetype, writing items as they are generated
+def save_custom_dataset(custom_dataset, filename, filetype):
+    output_filename = filename + "." + filetype
+    start_stage("write")
+    projected_items = get_stage_rows("projection")[1]
+
+    try:
+        print(f"\n> Generating custom dataset and saving to {output_filename}...")
+        if filetype == "json":
+            with open(output_filename, "w", encoding="utf-8") as outfile:
+                write_json(custom_dataset, outfile, compact)
+        elif filetype == "ndjson":
+            with open(output_filename, "w", encoding="utf-8") as outfile:
+                write_ndjson(custom_dataset, outfile)
+        elif filetype == "csv":
+            # Write the CSV file with the columns for the selected options
+            with open(output_filename, "w", newline="") as outfile:
+                write_csv(custom_dataset, outfile, get_output_keys())
+        logging.info(f"Saving file: {output_filename}")
+        print(f"> Saved {output_filename}\n")
+        return True
+    except IOError as e:
+        logging.error(f"Failed to save {output_filename}. {e}")
+        print(f"! Failed to save {output_filename}")
+        return False
+    finally:
+        written_items = get_stage_rows("projection")[1] - projected_items
+        stop_stage("write", written_items, written_items)
+
+
+# Build a prefix autocomplete index of the names (and selected alternate names) of each place
+def build_autocomplete_index(dataset):
+    from world_cities import AutocompleteIndex
+
+    start_spinner("Building autocomplete index")
+    index = AutocompleteIndex()
+    for value in dataset.values():
+        names = [value.name, value.asciiname]
+        if value.alternatenames:
+            for language, alternate_names in value.alternatenames.items():
+                if "all" in autocompleteLanguages or language in autocompleteLanguages:
+                    names.extend(alternate_names)
+        city = {
+            "geonameid": value.geonameid,
+            "name": value.name,
+            "country": value.country_code,
+            "lat": value.latitude,
+            "lng": value.longitude,
+            "population": value.population,
+        }
+        index.add(names, city, value.population)
+    index.build()
+    stop_spinner(f"{len(index.keys)} names")
+    return index
+
+
+# Save an autocomplete index next to an output file
+def save_autocomplete_index(index, filename):
+    try:
+        output_filename = index.save(filename + ".autocomplete")
+        logging.info(f"Saving file: {output_filename}")
+        print(f"> Saved {output_filename}\n")
+    except IOError as e:
+        logging.error(f"Failed to save {filename}.autocomplete. {e}")
+        print(f"! Failed to save {filename}.autocomplete")
+
+
 # Main function
 def main():
     global filetype
     global filename
 
+    # Arg - Convert
+    if args.convert:
+        convert_file(args.convert, args.convert_format)
+        return
+
+    # Arg - Version
+    if args.version:
+        print(f"GetWorldCities {version}")
+        return
+
+    # Arg - Serve
+    if args.serve:
+        from world_cities import serve
+
+        serve(args.serve, args.host, args.port)
+        return
+
+    load_libraries()
+    signal.signal(signal.SIGINT, signal_handler)
+
+    if warmCache == True:
+        warm_lookup_cache()
+        return
+
+    if matrix == True:
+        build_matrix(matrix_thresholds, matrix_presets, matrix_formats)
+        return
+
     if resume == True:
-        resumeFromSave()
+        population_threshold = resumeFromSave()
+        # A stopped matrix build carries on as a matrix build
+        if matrix == True:
+            build_matrix(matrix_thresholds, matrix_presets, matrix_formats)
+            return
     else:
         # If preset argument is used, set preset defaults, otherwise, prompt user
-        if preset == 1:
-            population_threshold = threshold
-            if threshold == 1000:
-                filename = "world_cities"
-            else:
-                filename = f"world_cities_{threshold}"
-            filetype = "csv"
-        elif preset == 2:
-            population_threshold = threshold
-            if threshold == 1000:
-                filename = "world_cities_(including_US_states)"
-            else:
-                filename = f"world_cities_{threshold}_(including_US_states)"
-            filetype = "csv"
-        elif preset == 3:
-            population_threshold = threshold
-            if threshold == 1000:
-                filename = (
-                    "world_cities_(including_states_and_counties_for_duplicate_names)"
-                )
-            else:
-                filename = f"world_cities_{threshold}_(including_states_and_counties_for_duplicate_names)"
-            filetype = "csv"
-        elif preset == 0:
-            population_threshold = threshold
-            if threshold == 1000:
-                filename = "world_cities_(including_all_states_and_counties)"
-            else:
-                filename = (
-                    f"world_cities_{threshold}_(including_all_states_and_counties)"
-                )
-            filetype = "csv"
-        elif preset == 4:
+        if preset is not None:
             population_threshold = threshold
-            if threshold == 1000:
-                filename = "world_cities_(including_all_states_counties_elevations)"
-            else:
-                filename = (
-                    f"world_cities_{threshold}_(including_all_states_and_counties_elevations)"
-                )
+            filename = get_preset_filename(preset, threshold)
             filetype = "csv"
         else:
             title()
@@ -1693,7 +3638,7 @@ def main():
                 population_threshold = threshold
 
             # File format prompt
-            filetype = get_format("? Enter file format ('json' or 'csv'): ")
+            filetype = get_format("? Enter file format ('json', 'ndjson' or 'csv'): ")
 
             # Filename prompt
             if output is None:
@@ -1705,52 +3650,23 @@ def main():
             filename = filename.rsplit(".", 1)[0]
 
     # Get custom dataset
-    if resume == True:
-        custom_dataset_json = process_datasets_2()
-    else:
-        custom_dataset_json = process_datasets(population_threshold)
+    custom_dataset = process_datasets(population_threshold)
 
-    # Save the output data
-    output_filename = filename + "." + filetype
+    # Save the output data (keeping the resume files if any lookups failed, so they can be retried with --resume)
+    if save_custom_dataset(custom_dataset, filename, filetype):
+        if not report_dead_letters():
+            clear_resume_files()
+        if autocomplete:
+            save_autocomplete_index(build_autocomplete_index(combined_dataset), filename)
 
-    try:
-        if filetype == "json":
-            start_spinner(f"Saving to {output_filename}")
-            with open(output_filename, "w", encoding="utf-8") as outfile:
-                json.dump(custom_dataset_json, outfile, ensure_ascii=False, indent=2)
-                logging.info(f"Saving file: {outfile}")
-                stop_spinner("done\n")
-        elif filetype == "csv":
-            # Custom key order
-            custom_order = get_custom_csv_header_order()
-            # Write the JSON data to a CSV file with custom key order
-            start_spinner(f"Saving to {output_filename}")
-            with open(output_filename, "w", newline="") as outfile:
-                csv_writer = csv.writer(outfile)
-
-                # Write the header row using the custom order, but only include existing keys
-                existing_keys = [
-                    key
-                    for key in custom_order
-                    if any(key in item for item in custom_dataset_json)
-                ]
-                csv_writer.writerow(existing_keys)
-
-                # Write the data rows with custom key order, only including existing keys
-                for item in custom_dataset_json:
-                    row_data = [item.get(key, "") for key in existing_keys]
-                    csv_writer.writerow(row_data)
-
-                logging.info(f"Saving file: {output_filename}")
-            stop_spinner("done\n")
-    except IOError as e:
-        logging.error(f"Failed to save {output_filename}. {e}")
-        stop_spinner("failed")
+    print_elapsed_time()
+    write_metrics()
 
 
 # Detect CTRL+C
 def signal_handler(sig, frame):
     logging.error("\n! Script was killed by user.")
+    stop_lookups()
     if (
         ("include_state" in globals())
         and ("include_county" in globals())
@@ -1763,7 +3679,6 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
-signal.signal(signal.SIGINT, signal_handler)
-
 if __name__ == "__main__":
+    parse_arguments()
     main()
@@ -0,0 +1,685 @@
+#!/usr/bin/env python
+
+# WorldCities
+#
+# Author: github.com/joelacus
+#
+# Repo: github.com/joelacus/world-cities
+#
+# Query the world_cities csv/json/ndjson datasets from python.
+#
+# Usage:
+#   from world_cities import WorldCities
+#   cities = WorldCities("world_cities_15000.csv")
+#   cities.get(2643743)  (only if the dataset includes geonameid)
+#   cities.by_country("GB")
+#   cities.find("GB", "London")
+#
+#   from world_cities import AutocompleteIndex
+#   autocomplete = AutocompleteIndex.load("world_cities.autocomplete")
+#   autocomplete.search("lon", 10)
+#
+#   cities.nearest(51.5, -0.12)  (needs numpy)
+#   cities.nearest_batch(lats, lngs, country="GB", min_population=1000)
+#
+# Run "python get_world_cities_geo_data.py --serve <dataset>" to serve lookups over HTTP (see serve()).
+#
+# Run "python world_cities.py <dataset>..." to build a .index file next to each dataset so later loads skip parsing.
+
+import bisect
+import concurrent.futures
+import csv
+import heapq
+import json
+import marshal
+import math
+import os
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+
+index_version = 1
+# Most nearest city indexes (for different countries and populations) kept in memory at once
+nearest_cache_size = 32
+
+
+# Index file name for a dataset file
+def get_index_filename(filename):
+    return os.path.splitext(filename)[0] + ".index"
+
+
+# Read the rows of a dataset file as lists of values in column order
+def read_dataset(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    with open(filename, "r", encoding="utf-8") as file:
+        if extension == ".csv":
+            reader = csv.reader(file)
+            columns = next(reader, [])
+            return columns, [row for row in reader if len(row) == len(columns)]
+        if extension == ".json":
+            items = json.load(file)
+        elif extension == ".ndjson":
+            items = [json.loads(line) for line in file if line.strip()]
+        else:
+            raise ValueError(f"Unsupported dataset format: {filename}")
+    columns = []
+    for item in items:
+        for key in item:
+            if key not in columns:
+                columns.append(key)
+    return columns, [[item.get(column, "") for column in columns] for item in items]
+
+
+# Lazily loaded, indexed world cities dataset
+class WorldCities:
+    def __init__(self, filename, index_filename=None):
+        self.filename = filename
+        self.index_filename = index_filename or get_index_filename(filename)
+        self.columns = None
+        self.values = None
+        self.geonameid_index = None
+        self.country_index = None
+        self.name_index = None
+        self.nearest_indexes = OrderedDict()
+        self.nearest_lock = threading.Lock()
+
+    # Size and modification time of the dataset file, used to detect stale index files
+    def source_stamp(self):
+        source = os.stat(self.filename)
+        return (source.st_size, source.st_mtime_ns)
+
+    # Load the dataset (from the index file if it is up to date) the first time it is needed
+    def load(self):
+        if self.columns is not None:
+            return self
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, "rb") as file:
+                try:
+                    index = marshal.loads(file.read())
+                except (EOFError, ValueError, TypeError):
+                    index = None
+            if index and index.get("version") == index_version and index.get("source") == self.source_stamp():
+                self.columns = index["columns"]
+                self.values = index["values"]
+                self.geonameid_index = index["geonameid"]
+                self.country_index = index["country"]
+                self.name_index = index["name"]
+                return self
+        self.build(*read_dataset(self.filename))
+        return self
+
+    # Store the rows column by column and build the indexes
+    def build(self, columns, rows):
+        # Repeated values (country codes, state and county names) share one string object
+        self.columns = columns
+        self.values = [[sys.intern(value) if isinstance(value, str) else value for value in column] for column in zip(*rows)] if rows else [[] for column in columns]
+        self.geonameid_index = {}
+        self.country_index = {}
+        self.name_index = {}
+        country_values = self.values[columns.index("country")] if "country" in columns else None
+        name_values = self.values[columns.index("name")] if "name" in columns else None
+        geonameid_values = self.values[columns.index("geonameid")] if "geonameid" in columns else None
+        for i in range(len(rows)):
+            if geonameid_values is not None and geonameid_values[i] not in ("", None):
+                self.geonameid_index[int(geonameid_values[i])] = i
+            if country_values is not None:
+                country = str(country_values[i]).upper()
+                self.country_index.setdefault(country, []).append(i)
+                if name_values is not None:
+                    self.name_index.setdefault((country, str(name_values[i]).casefold()), []).append(i)
+
+    # Write the loaded dataset and its indexes to the index file
+    def save_index(self):
+        self.load()
+        index = {
+            "version": index_version,
+            "source": self.source_stamp(),
+            "columns": self.columns,
+            "values": self.values,
+            "geonameid": self.geonameid_index,
+            "country": self.country_index,
+            "name": self.name_index,
+        }
+        with open(self.index_filename + ".part", "wb") as file:
+            marshal.dump(index, file)
+        os.replace(self.index_filename + ".part", self.index_filename)
+        return self.index_filename
+
+    def __len__(self):
+        self.load()
+        return len(self.values[0]) if self.values else 0
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    # Build a dict for a row
+    def row(self, i):
+        return {column: values[i] for column, values in zip(self.columns, self.values)}
+
+    # Find a city by geonameid
+    def get(self, geonameid, default=None):
+        self.load()
+        i = self.geonameid_index.get(int(geonameid))
+        return self.row(i) if i is not None else default
+
+    # All cities in a country (2 letter country code)
+    def by_country(self, country):
+        self.load()
+        return [self.row(i) for i in self.country_index.get(country.upper(), ())]
+
+    # Cities in a country with a name (case insensitive)
+    def find(self, country, name):
+        self.load()
+        return [self.row(i) for i in self.name_index.get((country.upper(), name.casefold()), ())]
+
+    # Country codes in the dataset
+    def countries(self):
+        self.load()
+        return sorted(self.country_index)
+
+    # Values of a column as floats (0 for missing values)
+    def float_column(self, column):
+        self.load()
+        if column not in self.columns:
+            return [0.0] * len(self)
+        return [float(value) if value not in ("", None) else 0.0 for value in self.values[self.columns.index(column)]]
+
+    # Nearest city index for the cities in a country and/or over a population (all cities by default).
+    # Only the last nearest_cache_size indexes are kept, and unknown countries share one empty index.
+    def nearest_index(self, country=None, min_population=None):
+        self.load()
+        country = country.upper() if country else None
+        if country is not None and country not in self.country_index:
+            country, min_population = "", None
+        key = (country, None if min_population is None else float(min_population))
+        with self.nearest_lock:
+            if key in self.nearest_indexes:
+                self.nearest_indexes.move_to_end(key)
+                return self.nearest_indexes[key]
+            numpy = import_numpy()
+            rows = numpy.arange(len(self))
+            if country is not None:
+                rows = numpy.array(self.country_index.get(country, []), dtype=numpy.int64)
+            if min_population is not None:
+                populations = numpy.array(self.float_column("population"))
+                rows = rows[populations[rows] >= min_population]
+            lats = numpy.array(self.float_column("lat"))[rows]
+            lngs = numpy.array(self.float_column("lng"))[rows]
+            self.nearest_indexes[key] = NearestCityIndex(lats, lngs, rows)
+            # The index of all cities is built up front by serve(), so it is never evicted
+            for old_key in list(self.nearest_indexes)[: max(0, len(self.nearest_indexes) - nearest_cache_size)]:
+                if old_key != (None, None):
+                    del self.nearest_indexes[old_key]
+            return self.nearest_indexes[key]
+
+    # Nearest city to a point, with its distance in metres added as "distance" (None if there are no cities)
+    def nearest(self, lat, lng, country=None, min_population=None):
+        rows, distances = self.nearest_index(country, min_population).query([lat], [lng])
+        if rows[0] < 0:
+            return None
+        city = self.row(int(rows[0]))
+        city["distance"] = float(distances[0])
+        return city
+
+    # Row numbers (-1 if there are no cities) and distances in metres of the nearest city to each point.
+    # Large batches are split across worker processes.
+    def nearest_batch(self, lats, lngs, country=None, min_population=None, workers=None):
+        return self.nearest_index(country, min_population).query_parallel(lats, lngs, workers)
+
+
+# ===== Autocomplete =====
+
+autocomplete_version = 1
+
+# Letters that don't decompose into a base letter and accents
+folded_letters = str.maketrans({"ø": "o", "ł": "l", "đ": "d", "ħ": "h", "ı": "i", "ŀ": "l", "ŧ": "t", "æ": "ae", "œ": "oe", "þ": "th"})
+
+
+# Case and accent insensitive key for a name ("Zürich" and "zurich" both become "zurich")
+def fold_key(text):
+    text = unicodedata.normalize("NFKD", text.casefold().translate(folded_letters))
+    return "".join(char for char in text if not unicodedata.combining(char)).translate(folded_letters)
+
+
+# Prefix index over city names, returning the most populated matches first.
+# Keys are kept in a sorted list, and the top matches are precomputed for every prefix with more than scan_limit keys,
+# so a search never looks at more than scan_limit keys.
+class AutocompleteIndex:
+    top_size = 20
+    scan_limit = 256
+
+    def __init__(self):
+        self.keys = []
+        self.targets = []
+        self.cities = []
+        self.populations = []
+        self.top = {}
+
+    # Add a city under each of its names (name, asciiname, alternate names)
+    def add(self, names, city, population=0):
+        target = len(self.cities)
+        self.cities.append(city)
+        self.populations.append(int(population or 0))
+        for key in {fold_key(name) for name in names if name}:
+            if key:
+                self.keys.append(key)
+                self.targets.append(target)
+
+    # Sort the keys and precompute the top matches for large prefixes
+    def build(self):
+        entries = sorted(zip(self.keys, self.targets))
+        self.keys = [key for key, target in entries]
+        self.targets = [target for key, target in entries]
+        self.top = {}
+        ranges = [(0, len(self.keys))]
+        depth = 1
+        while ranges:
+            next_ranges = []
+            for lo, hi in ranges:
+                i = lo
+                while i < hi:
+                    if len(self.keys[i]) < depth:
+                        i += 1
+                        continue
+                    prefix = self.keys[i][:depth]
+                    j = bisect.bisect_left(self.keys, prefix + "\U0010ffff", i, hi)
+                    if j - i > self.scan_limit:
+                        self.top[prefix] = self.rank(i, j, self.top_size)
+                        next_ranges.append((i, j))
+                    i = j
+            ranges = next_ranges
+            depth += 1
+        return self
+
+    # Most populated distinct cities for the keys between lo and hi
+    def rank(self, lo, hi, limit):
+        return heapq.nlargest(limit, set(self.targets[lo:hi]), key=lambda target: (self.populations[target], -target))
+
+    # Cities with a name starting with the prefix, most populated first
+    def search(self, prefix, limit=10):
+        key = fold_key(prefix)
+        if not key:
+            return []
+        if key in self.top and limit <= self.top_size:
+            targets = self.top[key][:limit]
+        else:
+            lo = bisect.bisect_left(self.keys, key)
+            hi = bisect.bisect_left(self.keys, key + "\U0010ffff", lo)
+            targets = self.rank(lo, hi, limit)
+        return [self.cities[target] for target in targets]
+
+    # Build an index from a loaded WorldCities dataset
+    @classmethod
+    def from_dataset(cls, cities, languages=None):
+        index = cls()
+        for city in cities:
+            names = [city.get("name", ""), city.get("asciiname", "")]
+            altnames = city.get("altnames")
+            if isinstance(altnames, dict):
+                for language, language_names in altnames.items():
+                    if languages is None or language in languages:
+                        names.extend(language_names)
+            index.add(names, city, city.get("population", 0))
+        return index.build()
+
+    # Save the index (the cities must only contain str, int, float, list and dict values)
+    def save(self, filename):
+        index = {
+            "version": autocomplete_version,
+            "keys": self.keys,
+            "targets": self.targets,
+            "cities": self.cities,
+            "populations": self.populations,
+            "top": self.top,
+        }
+        with open(filename + ".part", "wb") as file:
+            marshal.dump(index, file)
+        os.replace(filename + ".part", filename)
+        return filename
+
+    # Load a saved index
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as file:
+            data = marshal.loads(file.read())
+        if data.get("version") != autocomplete_version:
+            raise ValueError(f"{filename} was built by a different version")
+        index = cls()
+        index.keys = data["keys"]
+        index.targets = data["targets"]
+        index.cities = data["cities"]
+        index.populations = data["populations"]
+        index.top = data["top"]
+        return index
+
+
+# ===== Nearest City =====
+
+earth_radius = 6371008.8
+
+
+# Import numpy, which is only needed for nearest city lookups
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required for nearest city lookups. Install it with: pip install numpy")
+    return numpy
+
+
+# Grid of cities bucketed by latitude and longitude for nearest city lookups.
+# Cities are sorted by grid cell, so the cities in a run of cells along a grid row are a contiguous slice.
+# Queries search a box around each point that contains a circle of the search radius, doubling the radius until
+# the nearest city found is inside the circle (so no city outside the box can be closer).
+class NearestCityIndex:
+    def __init__(self, lats, lngs, rows, cell_size=0.25):
+        numpy = import_numpy()
+        self.cell_size = cell_size
+        self.grid_rows = math.ceil(180 / cell_size)
+        self.grid_cols = math.ceil(360 / cell_size)
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        grid_row = numpy.clip(numpy.floor((lats + 90) / cell_size).astype(numpy.int64), 0, self.grid_rows - 1)
+        grid_col = numpy.floor((lngs + 180) / cell_size).astype(numpy.int64) % self.grid_cols
+        cells = grid_row * self.grid_cols + grid_col
+        order = numpy.argsort(cells, kind="stable")
+        self.lats = numpy.radians(lats[order])
+        self.lngs = numpy.radians(lngs[order])
+        self.cos_lats = numpy.cos(self.lats)
+        self.rows = numpy.asarray(rows, dtype=numpy.int64)[order]
+        self.cell_start = numpy.searchsorted(cells[order], numpy.arange(self.grid_rows * self.grid_cols + 1))
+
+    # Row numbers (-1 if the index is empty) and distances in metres of the nearest city to each point
+    def query(self, lats, lngs, chunk_size=20000):
+        numpy = import_numpy()
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        if len(lats) > chunk_size:
+            results = [self.query(lats[i : i + chunk_size], lngs[i : i + chunk_size], chunk_size) for i in range(0, len(lats), chunk_size)]
+            return numpy.concatenate([rows for rows, distances in results]), numpy.concatenate([distances for rows, distances in results])
+
+        best_rows = numpy.full(len(lats), -1, dtype=numpy.int64)
+        best_angles = numpy.full(len(lats), numpy.inf)
+        if len(self.rows) == 0 or len(lats) == 0:
+            return best_rows, best_angles
+        point_lats = numpy.radians(lats)
+        point_lngs = numpy.radians(lngs)
+        active = numpy.arange(len(lats))
+        radius = numpy.full(len(lats), math.radians(self.cell_size))
+
+        while len(active):
+            # Bounding box of the search circle, in grid rows and columns (every column if it reaches a pole)
+            degrees = numpy.degrees(radius[active])
+            row_min = numpy.clip(numpy.floor((lats[active] - degrees + 90) / self.cell_size).astype(numpy.int64), 0, self.grid_rows - 1)
+            row_max = numpy.clip(numpy.floor((lats[active] + degrees + 90) / self.cell_size).astype(numpy.int64), 0, self.grid_rows - 1)
+            polar = numpy.abs(lats[active]) + degrees >= 90
+            half_width = numpy.degrees(numpy.arcsin(numpy.clip(numpy.sin(numpy.minimum(radius[active], math.pi / 2)) / numpy.cos(point_lats[active]), 0, 1)))
+            col_min = numpy.floor((lngs[active] - half_width + 180) / self.cell_size).astype(numpy.int64)
+            col_max = numpy.floor((lngs[active] + half_width + 180) / self.cell_size).astype(numpy.int64)
+            full = polar | (col_max - col_min + 1 >= self.grid_cols)
+            col_min = numpy.where(full, 0, col_min % self.grid_cols)
+            col_max = numpy.where(full, self.grid_cols - 1, col_max % self.grid_cols)
+            wraps = col_min > col_max
+
+            # Slices of cities in the box, one per grid row (two if the box wraps round at 180 degrees)
+            points = []
+            starts = []
+            ends = []
+            for row_offset in range(int((row_max - row_min).max()) + 1):
+                in_box = row_min + row_offset <= row_max
+                first_cell = (row_min + row_offset) * self.grid_cols
+                straight = in_box & ~wraps
+                points.append(active[straight])
+                starts.append(self.cell_start[(first_cell + col_min)[straight]])
+                ends.append(self.cell_start[(first_cell + col_max)[straight] + 1])
+                wrapped = in_box & wraps
+                points.extend([active[wrapped], active[wrapped]])
+                starts.extend([self.cell_start[(first_cell + col_min)[wrapped]], self.cell_start[first_cell[wrapped]]])
+                ends.extend([self.cell_start[first_cell[wrapped] + self.grid_cols], self.cell_start[(first_cell + col_max)[wrapped] + 1]])
+            points = numpy.concatenate(points)
+            starts = numpy.concatenate(starts)
+            counts = numpy.concatenate(ends) - starts
+
+            # Expand each slice into one (point, city) pair per city and keep the closest city for each point
+            pair_points = numpy.repeat(points, counts)
+            pair_cities = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+            a = numpy.sin((self.lats[pair_cities] - point_lats[pair_points]) / 2) ** 2 + numpy.cos(point_lats)[pair_points] * self.cos_lats[pair_cities] * numpy.sin((self.lngs[pair_cities] - point_lngs[pair_points]) / 2) ** 2
+            angles = 2 * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+            numpy.minimum.at(best_angles, pair_points, angles)
+            closest = angles == best_angles[pair_points]
+            best_rows[pair_points[closest]] = pair_cities[closest]
+
+            # Points whose nearest city so far is within the search circle are done. The others search again with
+            # a circle reaching that city (which can't miss a closer one), or double the radius if nothing was found.
+            done = (best_angles[active] <= radius[active]) | (radius[active] >= math.pi)
+            active = active[~done]
+            radius[active] = numpy.minimum(numpy.where(numpy.isfinite(best_angles[active]), best_angles[active], radius[active] * 2), math.pi)
+
+        found = best_rows >= 0
+        best_rows[found] = self.rows[best_rows[found]]
+        return best_rows, best_angles * earth_radius
+
+    # Query in parallel across worker processes (all cores by default), in chunks of chunk_size points
+    def query_parallel(self, lats, lngs, workers=None, chunk_size=100000):
+        numpy = import_numpy()
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(lats) <= chunk_size:
+            return self.query(lats, lngs)
+        chunks = [(lats[i : i + chunk_size], lngs[i : i + chunk_size]) for i in range(0, len(lats), chunk_size)]
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=set_worker_index, initargs=(self,)) as executor:
+            results = list(executor.map(query_worker_index, chunks))
+        return numpy.concatenate([rows for rows, distances in results]), numpy.concatenate([distances for rows, distances in results])
+
+
+# Index used by the worker processes of NearestCityIndex.query_parallel
+worker_index = None
+
+
+def set_worker_index(index):
+    global worker_index
+    worker_index = index
+
+
+def query_worker_index(chunk):
+    return worker_index.query(*chunk)
+
+
+# ===== HTTP Service =====
+#
+# GET  /city/<geonameid>
+# GET  /search?country=GB&name=London
+# GET  /autocomplete?q=lon&limit=10
+# GET  /nearest?lat=51.5&lng=-0.12[&country=GB][&min_population=1000]
+# POST /batch/city     {"geonameids": [2643743, ...]}
+# POST /batch/nearest  {"points": [[51.5, -0.12], ...], "country": "GB", "min_population": 1000}
+# GET  /stats          request counts and p50/p99 latencies per endpoint
+
+http_reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 501: "Not Implemented"}
+max_request_body = 64 * 1024 * 1024
+keep_alive_timeout = 60
+
+
+# Raised by a request handler to send an error response
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Lookups over one loaded dataset, served over HTTP/1.1 with keep-alive
+class LookupService:
+    def __init__(self, cities, autocomplete=None):
+        self.cities = cities
+        self.autocomplete = autocomplete
+        self.latencies = {}
+
+    # City dicts with their distance for nearest city results (None where there is no city)
+    def nearest_cities(self, lats, lngs, country=None, min_population=None):
+        try:
+            rows, distances = self.cities.nearest_batch(lats, lngs, country, min_population, workers=1)
+        except ImportError as e:
+            raise HTTPError(501, str(e))
+        results = []
+        for row, distance in zip(rows.tolist(), distances.tolist()):
+            if row < 0:
+                results.append(None)
+                continue
+            city = self.cities.row(row)
+            city["distance"] = distance
+            results.append(city)
+        return results
+
+    # Handle a request and return the response data
+    def handle(self, method, endpoint, query, body):
+        if method == "GET" and endpoint.startswith("/city/"):
+            city = self.cities.get(int(endpoint[len("/city/") :]))
+            if city is None:
+                raise HTTPError(404, "City not found")
+            return city
+        if method == "GET" and endpoint == "/search":
+            return self.cities.find(query["country"], query["name"])
+        if method == "GET" and endpoint == "/autocomplete":
+            if self.autocomplete is None:
+                raise HTTPError(501, "No autocomplete index")
+            return self.autocomplete.search(query["q"], int(query.get("limit", 10)))
+        if method == "GET" and endpoint == "/nearest":
+            min_population = float(query["min_population"]) if "min_population" in query else None
+            return self.nearest_cities([float(query["lat"])], [float(query["lng"])], query.get("country"), min_population)[0]
+        if method == "GET" and endpoint == "/stats":
+            return self.stats()
+        if endpoint in ("/batch/city", "/batch/nearest"):
+            if method != "POST":
+                raise HTTPError(405, "Use POST")
+            request = json.loads(body or b"{}")
+            if endpoint == "/batch/city":
+                return {"results": [self.cities.get(geonameid) for geonameid in request["geonameids"]]}
+            points = request["points"]
+            lats = [float(point[0]) for point in points]
+            lngs = [float(point[1]) for point in points]
+            return {"results": self.nearest_cities(lats, lngs, request.get("country"), request.get("min_population"))}
+        raise HTTPError(404, "Unknown endpoint")
+
+    # Request counts and latency percentiles (in milliseconds) per endpoint
+    def stats(self):
+        stats = {}
+        for endpoint, latencies in self.latencies.items():
+            ordered = sorted(latencies["recent"])
+            stats[endpoint] = {
+                "requests": latencies["count"],
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+                "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3),
+                "max_ms": round(ordered[-1] * 1000, 3),
+            }
+        return stats
+
+    # Record how long a request took (the last 10000 requests of each endpoint are kept)
+    def record_latency(self, endpoint, seconds):
+        if endpoint.startswith("/city/"):
+            endpoint = "/city"
+        latencies = self.latencies.setdefault(endpoint, {"count": 0, "recent": deque(maxlen=10000)})
+        latencies["count"] += 1
+        latencies["recent"].append(seconds)
+
+    # Read and answer requests on a connection until the client closes it or stops keeping it alive
+    async def handle_connection(self, reader, writer):
+        import asyncio
+        from urllib.parse import parse_qsl, urlsplit
+
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                status = 200
+                endpoint = "invalid"
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    method, target, protocol = request_line.decode("latin-1").split()
+                    keep_alive = keep_alive and (protocol == "HTTP/1.1" or headers.get("connection", "").lower() == "keep-alive")
+                    length = int(headers.get("content-length", 0))
+                    if length > max_request_body:
+                        keep_alive = False
+                        raise HTTPError(413, "Request body too large")
+                    body = await reader.readexactly(length) if length else b""
+                    url = urlsplit(target)
+                    endpoint = url.path
+                    query = dict(parse_qsl(url.query))
+                    # Batches and nearest city lookups (which may build an index) run on a worker thread so they don't hold up other connections
+                    if endpoint.startswith("/batch/") or endpoint == "/nearest":
+                        data = await loop.run_in_executor(None, self.handle, method, endpoint, query, body)
+                    else:
+                        data = self.handle(method, endpoint, query, body)
+                except HTTPError as e:
+                    status, data = e.status, {"error": str(e)}
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    status, data = 400, {"error": f"Bad request: {e}"}
+
+                response = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {http_reasons.get(status, '')}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {len(response)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + response
+                )
+                await writer.drain()
+                self.record_latency(endpoint, time.perf_counter() - start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, host, port):
+        import asyncio
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"> Serving {self.cities.filename} ({len(self.cities)} cities) on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+# Load a dataset (and its autocomplete index if there is one next to it) and serve lookups until interrupted
+def serve(filename, host="127.0.0.1", port=8080):
+    import asyncio
+
+    cities = WorldCities(filename).load()
+    autocomplete_filename = os.path.splitext(filename)[0] + ".autocomplete"
+    if os.path.exists(autocomplete_filename):
+        autocomplete = AutocompleteIndex.load(autocomplete_filename)
+    else:
+        autocomplete = AutocompleteIndex.from_dataset(cities)
+    try:
+        cities.nearest_index()
+    except ImportError as e:
+        print(f"! {e}")
+    try:
+        asyncio.run(LookupService(cities, autocomplete).run(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+# Build the index file for each dataset given on the command line
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python world_cities.py <dataset.csv|json|ndjson>...")
+        sys.exit(0)
+    for filename in sys.argv[1:]:
+        cities = WorldCities(filename)
+        print(f"> Saved {cities.save_index()} ({len(cities)} cities)")